@@ -0,0 +1,269 @@
+# src/algorithm/history.py
+
+# Imports
+import numpy as np
+
+# Per-row fields of the store and their trailing shapes, design rows have
+# num_params columns
+ROW_FIELDS = ["state", "action", "act_prob", "reward", "design", "decision_index"]
+
+
+class UserHistoryStore:
+    """
+    Columnar store of the users' decision histories. Every field is a
+    preallocated array of shape (users, rows, ...), and both capacities are
+    doubled when they run out, so appending a row is amortized O(1) and a
+    user's design matrix and rewards are zero-copy views.
+
+    Row j of a user holds the state, action, action probability, design row
+    and decision index of the user's j-th decision point. Its reward arrives
+    with the next decision point, so the first num_ts rows are the ones with
+    a reward. The running sufficient statistics over those rows are kept per
+    user as well.
+    """
+
+    def __init__(
+        self,
+        num_params: int,
+        state_size: int = 3,
+        user_capacity: int = 16,
+        row_capacity: int = 16,
+    ) -> None:
+        """
+        Initialize an empty store
+        :param num_params: length of a design row
+        :param state_size: length of a state
+        :param user_capacity: initial number of users
+        :param row_capacity: initial number of rows per user
+        """
+        self.num_params = num_params
+        self.state_size = state_size
+        self.user_capacity = max(1, int(user_capacity))
+        self.row_capacity = max(1, int(row_capacity))
+
+        # Users in the order they joined, and their row in the arrays
+        self.user_ids = []
+        self.index = {}
+
+        self.num_rows = np.zeros(self.user_capacity, dtype=int)
+        self.num_ts = np.zeros(self.user_capacity, dtype=int)
+        self.xtx = np.zeros((self.user_capacity, num_params, num_params))
+        self.xty = np.zeros((self.user_capacity, num_params))
+        self.sum_sq_reward = np.zeros(self.user_capacity)
+
+        self.rows = {
+            key: np.full(
+                (self.user_capacity, self.row_capacity, *shape), fill, dtype=dtype
+            )
+            for key, (shape, fill, dtype) in self._row_layout().items()
+        }
+
+    def _row_layout(self) -> dict:
+        """Trailing shape, fill value and dtype of each row field"""
+        return {
+            "state": ((self.state_size,), np.nan, float),
+            "action": ((), -1, int),
+            "act_prob": ((), np.nan, float),
+            "reward": ((), np.nan, float),
+            "design": ((self.num_params,), np.nan, float),
+            "decision_index": ((), -1, int),
+        }
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.index
+
+    def _grow(self, num_users: int, num_rows: int) -> None:
+        """
+        Double the capacities until they hold the given number of users and
+        rows per user. Views handed out before are left on the old arrays
+        :param num_users: number of users to hold
+        :param num_rows: number of rows per user to hold
+        """
+        user_capacity = self.user_capacity
+        while user_capacity < num_users:
+            user_capacity *= 2
+        row_capacity = self.row_capacity
+        while row_capacity < num_rows:
+            row_capacity *= 2
+
+        if row_capacity != self.row_capacity or user_capacity != self.user_capacity:
+            for key, (shape, fill, dtype) in self._row_layout().items():
+                rows = np.full((user_capacity, row_capacity, *shape), fill, dtype=dtype)
+                rows[: self.user_capacity, : self.row_capacity] = self.rows[key]
+                self.rows[key] = rows
+
+        if user_capacity != self.user_capacity:
+            for key in ["num_rows", "num_ts", "xtx", "xty", "sum_sq_reward"]:
+                old = getattr(self, key)
+                new = np.zeros((user_capacity, *old.shape[1:]), dtype=old.dtype)
+                new[: self.user_capacity] = old
+                setattr(self, key, new)
+
+        self.user_capacity = user_capacity
+        self.row_capacity = row_capacity
+
+    def add_user(self, user_id: str) -> int:
+        """
+        Add a user without any rows, if not in the store yet
+        :param user_id: user id of the user
+        :return: index of the user in the arrays
+        """
+        if user_id not in self.index:
+            self._grow(len(self.user_ids) + 1, self.row_capacity)
+            self.index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return self.index[user_id]
+
+    def append(
+        self,
+        user_id: str,
+        state: list,
+        action: int,
+        act_prob: float,
+        design_row: np.array,
+        decision_index: int,
+        reward: float,
+    ) -> np.array:
+        """
+        Append a decision point of a user, and record the reward of the user's
+        previous decision point in the sufficient statistics
+        :param user_id: user id of the user
+        :param state: state of the user
+        :param action: action of the user
+        :param act_prob: action probability of the user
+        :param design_row: design row of the decision point
+        :param decision_index: decision index of the user
+        :param reward: reward of the user for the LAST decision point, ignored
+                       for the first decision point of a user
+        :return: the previous design row if it received its reward, else None
+        """
+        idx = self.add_user(user_id)
+        row = self.num_rows[idx]
+        self._grow(self.user_capacity, row + 1)
+
+        rewarded = None
+        if row > 0:
+            # The last design row now has its reward
+            rewarded = self.rows["design"][idx, row - 1]
+            self.rows["reward"][idx, row - 1] = reward
+            self.xtx[idx] += np.outer(rewarded, rewarded)
+            self.xty[idx] += reward * rewarded
+            self.sum_sq_reward[idx] += reward**2
+            self.num_ts[idx] += 1
+
+        self.rows["state"][idx, row] = state
+        self.rows["action"][idx, row] = action
+        self.rows["act_prob"][idx, row] = act_prob
+        self.rows["design"][idx, row] = design_row
+        self.rows["decision_index"][idx, row] = decision_index
+        self.num_rows[idx] = row + 1
+
+        return rewarded
+
+    def extend(
+        self,
+        user_id: str,
+        state: np.array,
+        action: np.array,
+        act_prob: np.array,
+        design_rows: np.array,
+        decision_index: np.array,
+        reward: np.array,
+    ) -> int:
+        """
+        Append several decision points of a user at once, equivalent to calling
+        append for each of them in order
+        :param user_id: user id of the user
+        :param state: states of the decision points, shape (rows, state_size)
+        :param action: actions of the decision points
+        :param act_prob: action probabilities of the decision points
+        :param design_rows: design rows, shape (rows, num_params)
+        :param decision_index: decision indices of the decision points
+        :param reward: rewards, each for the decision point before it
+        :return: number of design rows which received their reward
+        """
+        idx = self.add_user(user_id)
+        count = len(design_rows)
+        if count == 0:
+            return 0
+
+        start = self.num_rows[idx]
+        stop = start + count
+        self._grow(self.user_capacity, stop)
+
+        self.rows["state"][idx, start:stop] = state
+        self.rows["action"][idx, start:stop] = action
+        self.rows["act_prob"][idx, start:stop] = act_prob
+        self.rows["design"][idx, start:stop] = design_rows
+        self.rows["decision_index"][idx, start:stop] = decision_index
+
+        # Each reward belongs to the row before it. The first reward of a new
+        # user has no row and is dropped
+        reward = np.asarray(reward, dtype=float)
+        if start == 0:
+            reward = reward[1:]
+        rewarded = slice(stop - 1 - len(reward), stop - 1)
+        self.rows["reward"][idx, rewarded] = reward
+
+        X = self.rows["design"][idx, rewarded]
+        self.xtx[idx] += X.T @ X
+        self.xty[idx] += X.T @ reward
+        self.sum_sq_reward[idx] += reward @ reward
+        self.num_ts[idx] += len(reward)
+        self.num_rows[idx] = stop
+
+        return len(reward)
+
+    def field(self, user_id: str, key: str) -> np.array:
+        """
+        View of a field over all of a user's rows
+        :param user_id: user id of the user
+        :param key: one of ROW_FIELDS
+        :return: view of the user's rows of the field
+        """
+        idx = self.index[user_id]
+        return self.rows[key][idx, : self.num_rows[idx]]
+
+    def design_matrix(self, user_id: str) -> np.array:
+        """
+        View of the design rows of a user which have received their reward
+        :param user_id: user id of the user
+        :return: array of shape (num_ts, num_params)
+        """
+        idx = self.index[user_id]
+        return self.rows["design"][idx, : self.num_ts[idx]]
+
+    def rewards(self, user_id: str) -> np.array:
+        """
+        View of the rewards of a user's design matrix rows
+        :param user_id: user id of the user
+        :return: array of shape (num_ts,)
+        """
+        idx = self.index[user_id]
+        return self.rows["reward"][idx, : self.num_ts[idx]]
+
+    def decision_indices(self, user_id: str) -> np.array:
+        """
+        View of the decision indices of a user's design matrix rows
+        :param user_id: user id of the user
+        :return: array of shape (num_ts,)
+        """
+        idx = self.index[user_id]
+        return self.rows["decision_index"][idx, : self.num_ts[idx]]
+
+    def statistics(self, user_id: str) -> dict:
+        """
+        Running sufficient statistics of a user
+        :param user_id: user id of the user
+        :return: dictionary with xtx, xty, sum_sq_reward and num_ts
+        """
+        idx = self.index[user_id]
+        return {
+            "xtx": self.xtx[idx],
+            "xty": self.xty[idx],
+            "sum_sq_reward": float(self.sum_sq_reward[idx]),
+            "num_ts": int(self.num_ts[idx]),
+        }
@@ -0,0 +1,156 @@
+# src/algorithm/parallel.py
+
+# Imports
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from src.algorithm.posterior import user_factors
+
+# Per-user factor arrays and their trailing shapes, as returned by user_factors
+FACTOR_KEYS = ["cond_cov", "gains", "offsets", "z2", "z4"]
+
+
+def _factor_shapes(size: int) -> dict:
+    return {
+        "cond_cov": (size, size),
+        "gains": (size, size),
+        "offsets": (size,),
+        "z2": (size,),
+        "z4": (size, size),
+    }
+
+
+def _attach(name: str, shape: tuple) -> tuple[shared_memory.SharedMemory, np.array]:
+    """Attach to a shared memory block and view it as a float array"""
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+
+def _factor_shard(
+    inputs: dict,
+    outputs: dict,
+    start: int,
+    stop: int,
+    sigma_u: np.array,
+    noise_var: float,
+) -> None:
+    """
+    Worker task: compute the factorizations of users [start, stop) and write
+    them into the shared output arrays
+    :param inputs: name and shape of the shared A_hat and B_hat arrays
+    :param outputs: name and shape of the shared output arrays
+    :param start: index of the first user of the shard
+    :param stop: index after the last user of the shard
+    :param sigma_u: random effects covariance matrix
+    :param noise_var: noise variance
+    """
+    handles = []
+    try:
+        arrays = {}
+        for key, (name, shape) in {**inputs, **outputs}.items():
+            shm, arrays[key] = _attach(name, shape)
+            handles.append(shm)
+
+        factors = user_factors(
+            sigma_u, noise_var, arrays["A_hat"][start:stop], arrays["B_hat"][start:stop]
+        )
+        for key in FACTOR_KEYS:
+            arrays[key][start:stop] = factors[key]
+
+        del arrays
+    finally:
+        for shm in handles:
+            shm.close()
+
+
+class ShardedFactorPool:
+    """
+    Computes the per-user posterior factorizations on a pool of worker
+    processes. Users are split into contiguous shards, and the stacked
+    per-user arrays are exchanged through shared memory rather than pickled.
+    """
+
+    def __init__(self, num_workers: int = 1, min_users_per_worker: int = 64) -> None:
+        """
+        Initialize the pool. Worker processes are only started on first use
+        :param num_workers: number of worker processes, 1 computes in process
+        :param min_users_per_worker: smallest shard worth sending to a worker
+        """
+        self.num_workers = max(1, int(num_workers))
+        self.min_users_per_worker = min_users_per_worker
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawn rather than fork, since the parent process runs jax threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def user_factors(
+        self, sigma_u: np.array, noise_var: float, A_hat: np.array, B_hat: np.array
+    ) -> dict:
+        """
+        Sharded version of posterior.user_factors
+        :param sigma_u: random effects covariance matrix
+        :param noise_var: noise variance
+        :param A_hat: per-user X_i^T X_i blocks, shape (N, 24, 24)
+        :param B_hat: per-user X_i^T y_i vectors, shape (N, 24)
+        :return: dictionary of stacked per-user arrays
+        """
+        A_hat = np.asarray(A_hat, dtype=float)
+        B_hat = np.asarray(B_hat, dtype=float)
+        total_users, size, _ = A_hat.shape
+
+        num_shards = min(self.num_workers, total_users // self.min_users_per_worker)
+        if num_shards <= 1:
+            return user_factors(sigma_u, noise_var, A_hat, B_hat)
+
+        shapes = {"A_hat": A_hat.shape, "B_hat": B_hat.shape}
+        for key, shape in _factor_shapes(size).items():
+            shapes[key] = (total_users, *shape)
+
+        blocks = {}
+        try:
+            arrays = {}
+            for key, shape in shapes.items():
+                blocks[key] = shared_memory.SharedMemory(
+                    create=True, size=int(np.prod(shape)) * np.dtype(float).itemsize
+                )
+                arrays[key] = np.ndarray(shape, dtype=float, buffer=blocks[key].buf)
+
+            arrays["A_hat"][:] = A_hat
+            arrays["B_hat"][:] = B_hat
+
+            inputs = {key: (blocks[key].name, shapes[key]) for key in ["A_hat", "B_hat"]}
+            outputs = {key: (blocks[key].name, shapes[key]) for key in FACTOR_KEYS}
+
+            bounds = np.linspace(0, total_users, num_shards + 1).astype(int)
+            executor = self._get_executor()
+            futures = [
+                executor.submit(
+                    _factor_shard, inputs, outputs, start, stop, sigma_u, noise_var
+                )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            for future in futures:
+                future.result()
+
+            factors = {key: np.array(arrays[key]) for key in FACTOR_KEYS}
+            del arrays
+        finally:
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+
+        return factors
+
+    def shutdown(self) -> None:
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,499 @@
+# src/algorithm/posterior.py
+
+# Imports
+import numpy as np
+
+
+def user_factors(
+    sigma_u: np.array, noise_var: float, A_hat: np.array, B_hat: np.array
+) -> dict:
+    """
+    Per-user factorizations used by the block posterior. They only depend on
+    each user's own sufficient statistics and the hyperparameters, so they can
+    be cached between updates for users who have no new data
+    :param sigma_u: random effects covariance matrix
+    :param noise_var: noise variance
+    :param A_hat: per-user X_i^T X_i blocks, shape (N, 24, 24)
+    :param B_hat: per-user X_i^T y_i vectors, shape (N, 24)
+    :return: dictionary of stacked per-user arrays
+    """
+    A_hat = np.asarray(A_hat, dtype=float)
+    B_hat = np.asarray(B_hat, dtype=float)
+
+    # Loop invariant inverse
+    sigma_u_inv = np.linalg.inv(sigma_u)
+
+    # Stacked (N x 24 x 24) per-user systems
+    psi = noise_var * sigma_u_inv + A_hat
+    psi_inv = np.linalg.inv(psi)
+    A_psi_inv = A_hat @ psi_inv
+
+    # Conditional posterior of theta_i given theta pop
+    cond_cov = noise_var * psi_inv
+
+    return {
+        "cond_cov": cond_cov,
+        "gains": cond_cov @ sigma_u_inv,
+        "offsets": np.linalg.solve(psi, B_hat[..., None])[..., 0],
+        "z2": np.einsum("nij,nj->ni", A_psi_inv, B_hat),
+        "z4": A_psi_inv @ A_hat,
+    }
+
+
+def block_posterior(
+    prior_mean: np.array,
+    prior_cov: np.array,
+    sigma_u: np.array,
+    noise_var: float,
+    A_hat: np.array,
+    B_hat: np.array,
+    factors: dict = None,
+) -> "PosteriorState":
+    """
+    Compute the posterior of the mixed effects model without forming the
+    dense (24N x 24N) matrices.
+
+    The prior covariance of theta is 1 (x) Sigma_0 + I (x) Sigma_u, i.e.
+    theta_i = theta_pop + u_i, and A is block diagonal. Eliminating each
+    user's block leaves a single 24 x 24 system for theta pop, after which
+    every user's posterior is theta_i = K_i theta_pop + c_i + e_i with
+    e_i ~ N(0, Lambda_i^-1) independent of theta_pop. This makes the cost
+    linear in the number of users.
+
+    :param prior_mean: prior mean of theta pop (Sigma_0 mean)
+    :param prior_cov: prior covariance of theta pop (Sigma_0)
+    :param sigma_u: random effects covariance matrix
+    :param noise_var: noise variance
+    :param A_hat: per-user X_i^T X_i blocks, shape (N, 24, 24)
+    :param B_hat: per-user X_i^T y_i vectors, shape (N, 24)
+    :param factors: per-user factorizations from user_factors, computed
+                    here if not given
+    :return: posterior state holding the per-user posterior means and
+             covariance blocks, the gains K_i and the theta pop posterior
+    """
+    A_hat = np.asarray(A_hat, dtype=float)
+    B_hat = np.asarray(B_hat, dtype=float)
+    total_users, size, _ = A_hat.shape
+    m_inv = 1.0 / total_users
+
+    if factors is None:
+        factors = user_factors(sigma_u, noise_var, A_hat, B_hat)
+
+    cond_cov = factors["cond_cov"]
+    gains = factors["gains"]
+    offsets = factors["offsets"]
+
+    prior_cov_inv = np.linalg.inv(prior_cov)
+
+    zeta1 = m_inv * B_hat.sum(axis=0)
+    zeta2 = m_inv * factors["z2"].sum(axis=0)
+    zeta3 = m_inv * A_hat.sum(axis=0)
+    zeta4 = m_inv * factors["z4"].sum(axis=0)
+
+    # Compute the theta pop posterior
+    E = (
+        m_inv * prior_cov_inv
+        + (1.0 / noise_var) * zeta3
+        - (1.0 / noise_var) * zeta4
+    )
+
+    E_inv = np.linalg.inv(E)
+
+    theta_pop_mean = E_inv @ (
+        m_inv * prior_cov_inv @ prior_mean.reshape(-1, 1)
+        + (1.0 / noise_var) * zeta1.reshape(-1, 1)
+        - (1.0 / noise_var) * zeta2.reshape(-1, 1)
+    )
+    theta_pop_cov = m_inv * E_inv
+
+    # Propagate the theta pop posterior to every user
+    posterior_mean = (gains @ theta_pop_mean).reshape(total_users, size) + offsets
+    cov_blocks = cond_cov + gains @ theta_pop_cov @ gains.transpose(0, 2, 1)
+
+    return PosteriorState(
+        posterior_mean, cov_blocks, gains, theta_pop_mean, theta_pop_cov
+    )
+
+
+class PosteriorState:
+    """
+    Compact representation of the joint posterior over all users' theta.
+
+    Only the per-user mean and diagonal covariance blocks are stored, along
+    with the per-user gains K_i and the theta pop posterior covariance. The
+    off-diagonal block between users i and j is K_i Sigma_pop K_j^T, so any
+    block of the dense (24N x 24N) covariance can be rebuilt on demand while
+    memory stays linear in the number of users.
+
+    The arrays are read-only once the state is built. Online refreshes of a
+    single user go into a small dictionary of overridden blocks on a new
+    state, so published states are never modified.
+    """
+
+    def __init__(
+        self,
+        mean: np.array,
+        cov_blocks: np.array,
+        gains: np.array,
+        theta_pop_mean: np.array,
+        theta_pop_cov: np.array,
+        overrides: dict = None,
+    ) -> None:
+        """
+        Initialize the posterior state
+        :param mean: per-user posterior means, shape (N, 24)
+        :param cov_blocks: per-user posterior covariance blocks, shape (N, 24, 24)
+        :param gains: per-user gains K_i, shape (N, 24, 24), or None if the
+                      coupling between users is not known
+        :param theta_pop_mean: theta pop posterior mean
+        :param theta_pop_cov: theta pop posterior covariance
+        :param overrides: user index to (mean, covariance block) refreshed
+                          since the arrays were computed
+        """
+        self.mean = _read_only(mean)
+        self.cov_blocks = _read_only(cov_blocks)
+        self.gains = None if gains is None else _read_only(gains)
+        self.theta_pop_mean = _read_only(theta_pop_mean)
+        self.theta_pop_cov = _read_only(theta_pop_cov)
+        self.overrides = {} if overrides is None else overrides
+
+    @property
+    def num_users(self) -> int:
+        return self.mean.shape[0]
+
+    def mean_block(self, i: int) -> np.array:
+        """
+        Get the posterior mean of a user
+        :param i: index of the user
+        :return: posterior mean of the user
+        """
+        if i in self.overrides:
+            return self.overrides[i][0]
+        return self.mean[i]
+
+    def cov_block(self, i: int, j: int = None) -> np.array:
+        """
+        Get a block of the posterior covariance
+        :param i: index of the row user
+        :param j: index of the column user, defaults to i
+        :return: posterior covariance between users i and j
+        """
+        if j is None or i == j:
+            if i in self.overrides:
+                return self.overrides[i][1]
+            return self.cov_blocks[i]
+
+        if self.gains is None:
+            raise ValueError("Posterior state does not store the coupling between users")
+
+        return self.gains[i] @ self.theta_pop_cov @ self.gains[j].T
+
+    def rank_one_update(
+        self, i: int, design_row: np.array, reward: float, noise_var: float
+    ) -> "PosteriorState":
+        """
+        Condition user i's posterior on one new observation with a rank-one
+        (Sherman-Morrison) update of its mean and covariance block. The user's
+        marginal posterior is exact, but the coupling to the other users is
+        left as of the last batch update
+        :param i: index of the user
+        :param design_row: design row of the new observation
+        :param reward: reward of the new observation
+        :param noise_var: noise variance
+        :return: new posterior state sharing the arrays of this one
+        """
+        design_row = np.asarray(design_row, dtype=float)
+        mean = self.mean_block(i)
+        cov = self.cov_block(i)
+
+        cov_x = cov @ design_row
+        innovation_var = noise_var + design_row @ cov_x
+        residual = reward - design_row @ mean
+
+        overrides = dict(self.overrides)
+        overrides[i] = (
+            _read_only(mean + cov_x * (residual / innovation_var)),
+            _read_only(cov - np.outer(cov_x, cov_x) / innovation_var),
+        )
+
+        return PosteriorState(
+            self.mean,
+            self.cov_blocks,
+            self.gains,
+            self.theta_pop_mean,
+            self.theta_pop_cov,
+            overrides=overrides,
+        )
+
+    def dense_cov(self) -> np.array:
+        """
+        Assemble the full (24N x 24N) posterior covariance. Only meant for
+        debugging and analysis, since it is quadratic in the number of users
+        :return: dense posterior covariance
+        """
+        if self.gains is None:
+            raise ValueError("Posterior state does not store the coupling between users")
+
+        total_users, size = self.mean.shape
+
+        coupled = self.gains @ self.theta_pop_cov
+        dense = np.einsum("iab,jcb->iajc", coupled, self.gains)
+        for i in range(total_users):
+            dense[i, :, i, :] = self.cov_block(i)
+
+        return dense.reshape(total_users * size, total_users * size)
+
+    def to_params(self) -> dict:
+        """
+        Serialize the posterior state for storage in the database
+        :return: dictionary of nested lists
+        """
+        mean = np.array(self.mean)
+        cov_blocks = np.array(self.cov_blocks)
+        for i, (mean_i, cov_i) in self.overrides.items():
+            mean[i] = mean_i
+            cov_blocks[i] = cov_i
+
+        return {
+            "posterior_mean_array": mean.reshape(-1, 1).tolist(),
+            "posterior_var_array": cov_blocks.tolist(),
+            "posterior_gain_array": None if self.gains is None else self.gains.tolist(),
+        }
+
+    @classmethod
+    def from_params(
+        cls,
+        posterior_mean_array,
+        posterior_var_array,
+        posterior_gain_array,
+        theta_pop_mean: np.array,
+        theta_pop_cov: np.array,
+    ) -> "PosteriorState":
+        """
+        Rebuild the posterior state from stored parameters. Also accepts the
+        older dense (24N x 24N) covariance, from which only the diagonal
+        blocks are kept
+        :param posterior_mean_array: stacked posterior means
+        :param posterior_var_array: per-user covariance blocks or dense covariance
+        :param posterior_gain_array: per-user gains, or None
+        :param theta_pop_mean: theta pop posterior mean
+        :param theta_pop_cov: theta pop posterior covariance
+        :return: posterior state
+        """
+        size = np.asarray(theta_pop_cov).shape[0]
+        mean = np.array(posterior_mean_array, dtype=float).reshape(-1, size)
+        cov = np.array(posterior_var_array, dtype=float)
+
+        if cov.ndim == 2:
+            # Dense covariance from before the compact representation
+            cov = np.array(
+                [
+                    cov[i * size : (i + 1) * size, i * size : (i + 1) * size]
+                    for i in range(mean.shape[0])
+                ]
+            )
+
+        if posterior_gain_array is not None:
+            posterior_gain_array = np.array(posterior_gain_array, dtype=float)
+
+        return cls(
+            mean,
+            cov,
+            posterior_gain_array,
+            np.array(theta_pop_mean, dtype=float),
+            np.array(theta_pop_cov, dtype=float),
+        )
+
+
+class PolicySnapshot:
+    """
+    Immutable snapshot of everything get_action reads. Every update builds a
+    new snapshot and publishes it with a single reference swap, so action
+    selection never blocks on an update and never sees a half-updated policy.
+
+    Publishing also precomputes what action selection needs per user: a dict
+    from user id to index, the posterior mean and covariance of the advantage
+    parameters as contiguous stacked arrays, and the advantage block of the
+    new-user posterior theta pop + u. So a request costs the same whatever
+    the number of users.
+
+    The snapshot can also carry a table of action probabilities, one row per
+    user plus a last row for new users, and one column per state.
+
+    An online refresh of a single user is copy on write: the new snapshot
+    shares the stacked arrays, and the user's refreshed advantage posterior
+    and probability row go into a small dictionary of overridden rows, so a
+    refresh costs the same whatever the number of users.
+    """
+
+    _fields = (
+        "policyid",
+        "user_list",
+        "posterior_state",
+        "theta_pop_mean",
+        "theta_pop_cov",
+        "sigma_u",
+        "noise_var",
+        "adv_size",
+        "prob_table",
+    )
+    __slots__ = _fields + (
+        "user_index",
+        "beta_mean",
+        "beta_cov",
+        "new_user_mean",
+        "new_user_cov",
+        "overrides",
+    )
+
+    # Fields the per-user arrays are derived from
+    _derived_from = (
+        "user_list",
+        "posterior_state",
+        "theta_pop_mean",
+        "theta_pop_cov",
+        "sigma_u",
+        "adv_size",
+    )
+
+    def __init__(
+        self,
+        policyid: int,
+        user_list: list,
+        posterior_state: PosteriorState,
+        theta_pop_mean: np.array,
+        theta_pop_cov: np.array,
+        sigma_u: np.array,
+        noise_var: float,
+        adv_size: int = 8,
+        prob_table: np.array = None,
+    ) -> None:
+        """
+        Initialize the policy snapshot
+        :param policyid: policy id
+        :param user_list: users with a posterior, in the order of the posterior state
+        :param posterior_state: per-user posterior, or None before the first update
+        :param theta_pop_mean: theta pop posterior mean
+        :param theta_pop_cov: theta pop posterior covariance
+        :param sigma_u: random effects covariance used for the posterior
+        :param noise_var: noise variance used for the posterior
+        :param adv_size: number of advantage parameters, the last ones of theta
+        :param prob_table: action probabilities of shape (N + 1, states), the
+                           last row for new users, or None if not computed
+        """
+        object.__setattr__(self, "policyid", policyid)
+        object.__setattr__(self, "user_list", list(user_list))
+        object.__setattr__(self, "posterior_state", posterior_state)
+        object.__setattr__(self, "theta_pop_mean", _read_only(theta_pop_mean))
+        object.__setattr__(self, "theta_pop_cov", _read_only(theta_pop_cov))
+        object.__setattr__(self, "sigma_u", _read_only(sigma_u))
+        object.__setattr__(self, "noise_var", noise_var)
+        object.__setattr__(self, "adv_size", adv_size)
+        object.__setattr__(
+            self, "prob_table", None if prob_table is None else _read_only(prob_table)
+        )
+
+        # Advantage posteriors of the users, and of a new user
+        adv = slice(-adv_size, None)
+        if posterior_state is None:
+            beta_mean = np.zeros((0, adv_size))
+            beta_cov = np.zeros((0, adv_size, adv_size))
+        else:
+            beta_mean = np.array(posterior_state.mean[:, adv])
+            beta_cov = np.array(posterior_state.cov_blocks[:, adv, adv])
+            for i, (mean, cov) in posterior_state.overrides.items():
+                beta_mean[i] = mean[adv]
+                beta_cov[i] = cov[adv, adv]
+
+        object.__setattr__(
+            self, "user_index", {user_id: i for i, user_id in enumerate(self.user_list)}
+        )
+        object.__setattr__(self, "beta_mean", _read_only(beta_mean))
+        object.__setattr__(self, "beta_cov", _read_only(beta_cov))
+        object.__setattr__(
+            self, "new_user_mean", _read_only(self.theta_pop_mean.reshape(-1)[adv])
+        )
+        object.__setattr__(
+            self, "new_user_cov", _read_only((self.theta_pop_cov + self.sigma_u)[adv, adv])
+        )
+        object.__setattr__(self, "overrides", {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PolicySnapshot is immutable")
+
+    def _copy(self, **changes) -> "PolicySnapshot":
+        """Shallow copy of the snapshot, with some slots replaced"""
+        snapshot = object.__new__(PolicySnapshot)
+        for name in self.__slots__:
+            object.__setattr__(snapshot, name, changes.get(name, getattr(self, name)))
+        return snapshot
+
+    def replace(self, **changes) -> "PolicySnapshot":
+        """
+        Create a copy of the snapshot with some fields replaced. The per-user
+        arrays are only rebuilt if a field they are derived from changes
+        :param changes: fields to replace
+        :return: new policy snapshot
+        """
+        if any(name in changes for name in self._derived_from):
+            fields = {name: getattr(self, name) for name in self._fields}
+            fields.update(changes)
+            return PolicySnapshot(**fields)
+
+        if changes.get("prob_table") is not None:
+            changes["prob_table"] = _read_only(changes["prob_table"])
+        return self._copy(**changes)
+
+    def refresh_user(
+        self, i: int, posterior_state: PosteriorState, prob_row: np.array = None
+    ) -> "PolicySnapshot":
+        """
+        Create a copy of the snapshot with user i's posterior refreshed online.
+        Only the user's advantage posterior and probability row are replaced,
+        everything else is shared with this snapshot
+        :param i: index of the user
+        :param posterior_state: posterior state with the user's block refreshed
+        :param prob_row: user's action probabilities in every state, or None if
+                         the snapshot has no probability table
+        :return: new policy snapshot
+        """
+        adv = slice(-self.adv_size, None)
+        overrides = dict(self.overrides)
+        overrides[i] = (
+            _read_only(posterior_state.mean_block(i)[adv]),
+            _read_only(posterior_state.cov_block(i)[adv, adv]),
+            None if prob_row is None else _read_only(prob_row),
+        )
+
+        return self._copy(posterior_state=posterior_state, overrides=overrides)
+
+    def advantage_block(self, i: int) -> tuple[np.array, np.array]:
+        """
+        Posterior mean and covariance of a user's advantage parameters
+        :param i: index of the user
+        :return: mean of shape (adv_size,) and covariance (adv_size, adv_size)
+        """
+        if i in self.overrides:
+            return self.overrides[i][:2]
+        return self.beta_mean[i], self.beta_cov[i]
+
+    def prob_row(self, i: int) -> np.array:
+        """
+        Action probabilities of a user in every state
+        :param i: index of the user, len(user_list) for a new user
+        :return: row of the probability table, None if there is no table
+        """
+        if i in self.overrides:
+            return self.overrides[i][2]
+        if self.prob_table is None:
+            return None
+        return self.prob_table[i]
+
+
+def _read_only(array) -> np.array:
+    """Read-only float copy of an array, arrays that are already read-only are shared"""
+    array = np.asarray(array, dtype=float)
+    if array.flags.writeable:
+        array = array.copy()
+        array.setflags(write=False)
+    return array
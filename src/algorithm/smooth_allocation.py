@@ -20,7 +20,9 @@ def get_allocation_function(
     L_max: float = 0.8,
 ) -> Callable:
     """
-    Gets the allocation function to be used for the run
+    Gets the allocation function to be used for the run. The allocation
+    functions take scalars or arrays of means and variances of the same shape,
+    and return the probabilities in that shape
     """
 
     def thompson_sampling(mean: float, var: float) -> float:
@@ -30,16 +32,10 @@ def get_allocation_function(
         prob = 1 - stats.norm.cdf(0, mean, np.sqrt(var))
         return prob
 
-    def logistic_function_infinity(x: float) -> float:
-        if x >= 0:
-            return L_max
-        else:
-            return L_min
-
     def smooth_posterior_sampling_inf(mean: float, var: float) -> float:
         std = np.sqrt(var)
-        samples = mean + (randomvars * std)
-        prob = np.mean([logistic_function_infinity(i) for i in samples])
+        samples = np.asarray(mean)[..., None] + (randomvars * np.asarray(std)[..., None])
+        prob = np.mean(np.where(samples >= 0, L_max, L_min), axis=-1)
 
         return prob
 
@@ -50,8 +46,8 @@ def get_allocation_function(
 
     def smooth_posterior_sampling(mean: float, var: float) -> float:
         std = np.sqrt(var)
-        samples = mean + (randomvars * std)
-        prob = np.mean(logistic_function(samples))
+        samples = np.asarray(mean)[..., None] + (randomvars * np.asarray(std)[..., None])
+        prob = np.mean(logistic_function(samples), axis=-1)
 
         # prob = stats.norm.expect(func=logistic_function, loc=mean, scale=np.sqrt(var))
         return prob
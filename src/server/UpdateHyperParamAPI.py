@@ -40,6 +40,13 @@ def update_hyperparam_task(id):
                                                     update_hyperparam=True,
                                                     use_data=False,
                                                     request_id=id)
+
+            # Iterations, restarts, final gradient norm and wall time of the fit,
+            # only if the fit of this request got far enough to report
+            fit_report = getattr(algorithm, "last_fit_report", {})
+            if fit_report.get("request_id") != id:
+                fit_report = None
+            app.logger.info("Hyperparameter fit report: %s", fit_report)
         
             if not status:
                 app.logger.error("Error updating hyper-parameters: %s", message)
@@ -51,6 +58,7 @@ def update_hyperparam_task(id):
                 request.request_message = message
                 request.request_error_code = ec
                 request.completed_timestamp = datetime.datetime.now()
+                request.fit_report = fit_report
                 db.session.commit()
             else:
                 app.logger.info("Updated hyper-parameters")
@@ -59,6 +67,7 @@ def update_hyperparam_task(id):
                 request = RLHyperParamUpdateRequest.query.filter_by(id=id).first()
                 request.request_status = "Completed"
                 request.completed_timestamp = datetime.datetime.now()
+                request.fit_report = fit_report
                 db.session.commit()
 
 
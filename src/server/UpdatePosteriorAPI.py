@@ -102,6 +102,10 @@ class UpdatePosteriorAPI(MethodView):
             
             app.logger.info("Updated posterior")
             app.logger.info("policyid: " + str(policyid))
+
+            # Number of users whose posterior factorizations were recomputed
+            update_report = getattr(algorithm, "last_update_report", {})
+            app.logger.info("Update report: %s", update_report)
             # app.logger.info("params: " + str(params))
 
             # Create a RLWeights object
@@ -110,6 +114,7 @@ class UpdatePosteriorAPI(MethodView):
                 update_timestamp=timenow,
                 posterior_mean_array=params.get("posterior_mean_array"),
                 posterior_var_array=params.get("posterior_var_array"),
+                posterior_gain_array=params.get("posterior_gain_array"),
                 posterior_theta_pop_mean_array=params.get(
                     "posterior_theta_pop_mean_array"
                 ),
@@ -146,6 +151,7 @@ class UpdatePosteriorAPI(MethodView):
                     "status": "success",
                     "message": "Successfully updated parameters/posteriors.",
                     "policyid": policyid,
+                    "num_users_recomputed": update_report.get("num_users_recomputed"),
                 }
 
                 return make_response(jsonify(responseObject)), 201
@@ -1,6 +1,7 @@
 # src/server/__init__.py
 
 import os
+import threading
 
 from flask import Flask
 from flask_bcrypt import Bcrypt
@@ -43,4 +44,13 @@ if app.config.get("RESTART"):
     app.logger.info("Server is being restarted")
     from src.server.restart import restart_server
     restart_server(app)
-    # app.config["RESTART"] = False
\ No newline at end of file
+    # app.config["RESTART"] = False
+
+# Compile the hyperparameter fit for the expected cohort sizes in the background
+if app.config.get("WARMUP"):
+    app.logger.info("Warming up the hyperparameter fit")
+    threading.Thread(
+        target=app.config["ALGORITHM"].warm_up,
+        args=(app.config.get("WARMUP_USERS"),),
+        daemon=True,
+    ).start()
\ No newline at end of file
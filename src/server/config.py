@@ -43,6 +43,27 @@ LOGISTIC_SIGMA = config["ALLOCATION_FUNCTION"]["LOGISTIC_SIGMA"]
 B = float(LOGISTIC_B) / float(LOGISTIC_SIGMA)
 
 restart = bool(config["ALGORITHM"]["RESTART"])
+online_update = config["ALGORITHM"].getboolean("ONLINE_UPDATE", fallback=False)
+num_workers = config["ALGORITHM"].getint("NUM_WORKERS", fallback=1)
+optimizer = config["ALGORITHM"].get("OPTIMIZER", fallback="gd")
+warm_start = config["ALGORITHM"].getboolean("WARM_START", fallback=True)
+compilation_cache_dir = config["ALGORITHM"].get("COMPILATION_CACHE_DIR", fallback="")
+warmup = config["ALGORITHM"].getboolean("WARMUP", fallback=False)
+warmup_users = config["ALGORITHM"].getint("WARMUP_USERS", fallback=128)
+num_starts = config["ALGORITHM"].getint("NUM_STARTS", fallback=1)
+gradient = config["ALGORITHM"].get("GRADIENT", fallback="autodiff")
+fit_window = config["ALGORITHM"].get("FIT_WINDOW", fallback="")
+fit_window = int(fit_window) if fit_window else None
+fit_subsample = config["ALGORITHM"].getfloat("FIT_SUBSAMPLE", fallback=1.0)
+fit_strata = config["ALGORITHM"].getint("FIT_STRATA", fallback=4)
+fit_minibatch = config["ALGORITHM"].get("FIT_MINIBATCH", fallback="")
+fit_minibatch = int(fit_minibatch) if fit_minibatch else None
+fit_epochs = config["ALGORITHM"].getint("FIT_EPOCHS", fallback=1)
+objective_cache_size = config["ALGORITHM"].getint("OBJECTIVE_CACHE_SIZE", fallback=1024)
+
+# Keep the compiled hyperparameter fit across restarts
+if compilation_cache_dir:
+    mixed_effects.enable_compilation_cache(compilation_cache_dir)
 
 # Load the random variables
 random_vars_path = config["ALLOCATION_FUNCTION"]["RANDOM_VARS_PATH"]
@@ -102,6 +123,8 @@ class BaseConfig:
     STUDY_INDEX = 0
     HEADERS = headers
     RESTART = restart
+    WARMUP = warmup
+    WARMUP_USERS = warmup_users
 
 
 class DevelopmentConfig(BaseConfig):
@@ -122,6 +145,18 @@ class DevelopmentConfig(BaseConfig):
         debug=True,
         logger_path="./data/logs",
         restart=restart,
+        online_update=online_update,
+        num_workers=num_workers,
+        optimizer=optimizer,
+        warm_start=warm_start,
+        num_starts=num_starts,
+        gradient=gradient,
+        fit_window=fit_window,
+        fit_subsample=fit_subsample,
+        fit_strata=fit_strata,
+        fit_minibatch=fit_minibatch,
+        fit_epochs=fit_epochs,
+        objective_cache_size=objective_cache_size,
     )
 
 
@@ -167,4 +202,16 @@ class ProductionConfig(BaseConfig):
         rng=np.random.default_rng(int(seed)),
         debug=True,
         logger_path="./data/logs",
+        online_update=online_update,
+        num_workers=num_workers,
+        optimizer=optimizer,
+        warm_start=warm_start,
+        num_starts=num_starts,
+        gradient=gradient,
+        fit_window=fit_window,
+        fit_subsample=fit_subsample,
+        fit_strata=fit_strata,
+        fit_minibatch=fit_minibatch,
+        fit_epochs=fit_epochs,
+        objective_cache_size=objective_cache_size,
     )
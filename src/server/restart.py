@@ -36,6 +36,7 @@ def restart_server(app):
             update_timestamp = rl_weights.update_timestamp
             posterior_mean_array = np.array(rl_weights.posterior_mean_array)
             posterior_var_array = np.array(rl_weights.posterior_var_array)
+            posterior_gain_array = rl_weights.posterior_gain_array
             posterior_theta_pop_mean_array = np.array(rl_weights.posterior_theta_pop_mean_array)
             posterior_theta_pop_var_array = np.array(rl_weights.posterior_theta_pop_var_array)
             noise_var = rl_weights.noise_var
@@ -46,6 +47,7 @@ def restart_server(app):
             params = {
                 "posterior_mean_array": posterior_mean_array,
                 "posterior_var_array": posterior_var_array,
+                "posterior_gain_array": posterior_gain_array,
                 "posterior_theta_pop_mean_array": posterior_theta_pop_mean_array,
                 "posterior_theta_pop_var_array": posterior_theta_pop_var_array,
                 "noise_var": noise_var,
@@ -54,20 +56,23 @@ def restart_server(app):
 
             rl_action_selection = db.session.query(RLActionSelection)
 
-            rl_actions = []
+            # Collect the records column by column, for the bulk replay
+            rl_actions = {
+                "user_id": [],
+                "action": [],
+                "state": [],
+                "act_prob": [],
+                "reward": [],
+                "decision_index": [],
+            }
 
             for record in rl_action_selection:
-
-                record_dict = {}
-
-                record_dict["user_id"] = record.user_id
-                record_dict["action"] = record.action
-                record_dict["state"] = record.state_vector
-                record_dict["act_prob"] = record.act_prob
-                record_dict["reward"] = record.reward
-                record_dict["decision_index"] = record.user_decision_idx
-
-                rl_actions.append(record_dict)
+                rl_actions["user_id"].append(record.user_id)
+                rl_actions["action"].append(record.action)
+                rl_actions["state"].append(record.state_vector)
+                rl_actions["act_prob"].append(record.act_prob)
+                rl_actions["reward"].append(record.reward)
+                rl_actions["decision_index"].append(record.user_decision_idx)
         
         # Set the algorithm's state to the most recent set of hyper-parameters
         status = algorithm.reset_rl(params, user_list, policy_id, hp_update_id, rl_actions)
@@ -119,6 +119,8 @@ class RLHyperParamUpdateRequest(db.Model):
     request_message = db.Column(db.String, nullable=True)
     request_error_code = db.Column(db.Integer, nullable=True)
     completed_timestamp = db.Column(db.DateTime, nullable=True)
+    # Convergence telemetry of the hyperparameter fit
+    fit_report = db.Column(db.JSON, nullable=True)
 
     def __init__(
         self,
@@ -128,6 +130,7 @@ class RLHyperParamUpdateRequest(db.Model):
         request_message: str = None,
         request_error_code: int = None,
         completed_timestamp: datetime.datetime = None,
+        fit_report: dict = None,
     ):
         self.backup_location = backup_location
         self.request_timestamp = request_timestamp
@@ -135,6 +138,7 @@ class RLHyperParamUpdateRequest(db.Model):
         self.request_message = request_message
         self.request_error_code = request_error_code
         self.completed_timestamp = completed_timestamp
+        self.fit_report = fit_report
 
 
 class RLWeights(db.Model):
@@ -148,7 +152,10 @@ class RLWeights(db.Model):
     policy_id = db.Column(db.Integer, nullable=False)
     update_timestamp = db.Column(db.DateTime, nullable=False)
     posterior_mean_array = db.Column(ARRAY(db.Float), nullable=True)
+    # Per-user diagonal blocks of the posterior covariance, (N x 24 x 24)
     posterior_var_array = db.Column(ARRAY(db.Float), nullable=True)
+    # Per-user gains K_i, used to rebuild the off-diagonal blocks
+    posterior_gain_array = db.Column(ARRAY(db.Float), nullable=True)
     posterior_theta_pop_mean_array = db.Column(ARRAY(db.Float), nullable=True)
     posterior_theta_pop_var_array = db.Column(ARRAY(db.Float), nullable=True)
     noise_var = db.Column(db.Float, nullable=True)
@@ -174,11 +181,13 @@ class RLWeights(db.Model):
         code_commit_id: str = app.config.get("CODE_VERSION"),
         data_pickle_file_path: str = None,
         user_list: list = None,
+        posterior_gain_array: list = None,
     ):
         self.policy_id = policy_id
         self.update_timestamp = update_timestamp
         self.posterior_mean_array = posterior_mean_array
         self.posterior_var_array = posterior_var_array
+        self.posterior_gain_array = posterior_gain_array
         self.posterior_theta_pop_mean_array = posterior_theta_pop_mean_array
         self.posterior_theta_pop_var_array = posterior_theta_pop_var_array
         self.noise_var = noise_var
@@ -0,0 +1,114 @@
+# src/tests/benchmark_posterior.py
+
+# Benchmarks the posterior computation for different cohort sizes.
+# Run from the repository root with: python -m src.tests.benchmark_posterior
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.linalg as linalg
+
+from src.algorithm.parallel import ShardedFactorPool
+from src.algorithm.posterior import block_posterior
+from src.tests.test_posterior import make_problem
+
+
+def best_time(func, repeats: int = 3) -> float:
+    """Best wall time of a few runs of func"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_workers(user_counts: list, worker_counts: list) -> None:
+    """Time the sharded per-user factorizations and the full posterior"""
+    print("users  workers  factors (s)  posterior (s)")
+    for nusers in user_counts:
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(nusers)
+        A_hat = np.array(A_hat)
+
+        reference = None
+        for num_workers in worker_counts:
+            pool = ShardedFactorPool(num_workers, min_users_per_worker=1)
+
+            # Start the worker processes outside of the timed region
+            factors = pool.user_factors(sigma_u, noise_var, A_hat, B_hat)
+            if reference is None:
+                reference = factors
+            for key, value in reference.items():
+                np.testing.assert_allclose(factors[key], value, rtol=1e-10, atol=1e-12)
+
+            factor_time = best_time(
+                lambda: pool.user_factors(sigma_u, noise_var, A_hat, B_hat)
+            )
+            posterior_time = best_time(
+                lambda: block_posterior(
+                    prior_mean,
+                    prior_cov,
+                    sigma_u,
+                    noise_var,
+                    A_hat,
+                    B_hat,
+                    factors=pool.user_factors(sigma_u, noise_var, A_hat, B_hat),
+                )
+            )
+            pool.shutdown()
+
+            print(f"{nusers:5d}  {num_workers:7d}  {factor_time:11.4f}  {posterior_time:13.4f}")
+
+
+def peak_memory(func) -> int:
+    """Peak traced memory allocated while running func, in bytes"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_memory(user_counts: list, max_dense_users: int = 500) -> None:
+    """
+    Compare the memory of A as a dense block diagonal (24N x 24N) matrix with
+    the stacked (N, 24, 24) blocks, and the peak memory of the block posterior.
+    The dense matrix is only built up to max_dense_users, above that its size
+    is computed
+    """
+    print("users  dense A (MB)  stacked A (MB)  posterior peak (MB)")
+    for nusers in user_counts:
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(nusers)
+        A_hat = np.array(A_hat)
+        size = A_hat.shape[1]
+
+        if nusers <= max_dense_users:
+            dense = peak_memory(lambda: linalg.block_diag(*A_hat))
+        else:
+            dense = (nusers * size) ** 2 * np.dtype(float).itemsize
+        posterior = peak_memory(
+            lambda: block_posterior(
+                prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat
+            )
+        )
+
+        print(
+            f"{nusers:5d}  {dense / 2**20:12.1f}  {A_hat.nbytes / 2**20:14.1f}  "
+            f"{posterior / 2**20:19.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[500, 2000, 8000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--memory-users", type=int, nargs="+", default=[100, 500, 2000]
+    )
+    args = parser.parse_args()
+
+    benchmark_memory(args.memory_users)
+    benchmark_workers(args.users, args.workers)
@@ -122,7 +122,10 @@ for idx, row in action_history.iterrows():
     else:
         post_mean = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_mean_array"].values[0]).reshape(-1, num_params)
         n = post_mean.shape[0]
-        post_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_var_array"].values[0]).reshape(num_params * n, num_params * n)
+        post_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_var_array"].values[0])
+        if post_var.ndim == 2:
+            # Older rows stored the dense (24N x 24N) covariance
+            post_var = np.array([post_var[i * num_params: (i + 1) * num_params, i * num_params: (i + 1) * num_params] for i in range(n)])
         theta_mean = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_theta_pop_mean_array"].values[0])
         theta_var = np.array(policy_table[(policy_table["policy_id"] == policy_id)]["posterior_theta_pop_var_array"].values[0])
         user_list = policy_table[(policy_table["policy_id"] == policy_id)]["user_list"].values[0]
@@ -134,7 +137,7 @@ for idx, row in action_history.iterrows():
     else:
         user_index = user_list.index(user_id)
         post_mean_user = post_mean[user_index]
-        post_var_user = post_var[user_index * num_params: (user_index + 1) * num_params, user_index * num_params: (user_index + 1) * num_params]
+        post_var_user = post_var[user_index]
 
     advantage_default = [
             1,
@@ -0,0 +1,80 @@
+# src/tests/test_allocation.py
+
+import unittest
+
+import numpy as np
+import scipy.special as special
+import scipy.stats as stats
+
+from src.algorithm.smooth_allocation import get_allocation_function
+
+
+def scalar_allocation(func_type, B, randomvars, C=5.0, L_min=0.2, L_max=0.8):
+    """Per-element allocation functions, as before they were vectorised"""
+
+    def thompson_sampling(mean, var):
+        return 1 - stats.norm.cdf(0, mean, np.sqrt(var))
+
+    def smooth_posterior_sampling_inf(mean, var):
+        samples = mean + (randomvars * np.sqrt(var))
+        return np.mean([L_max if x >= 0 else L_min for x in samples])
+
+    def smooth_posterior_sampling(mean, var):
+        samples = mean + (randomvars * np.sqrt(var))
+        return np.mean(
+            L_min + (L_max - L_min) * special.expit(B * samples - np.log(C))
+        )
+
+    if func_type == "thompson":
+        return thompson_sampling
+    if np.isinf(B):
+        return smooth_posterior_sampling_inf
+    return smooth_posterior_sampling
+
+
+class TestAllocationFunction(unittest.TestCase):
+    """Tests for the allocation functions"""
+
+    def test_vectorised_matches_scalar(self):
+        """Arrays of means and variances match the per-element functions"""
+        rng = np.random.default_rng(0)
+        randomvars = rng.normal(size=500)
+        mean = rng.normal(size=(3, 8))
+        var = rng.uniform(0.1, 2.0, size=(3, 8))
+
+        for func_type, B in [
+            ("smooth", 10 / 0.95),
+            ("smooth", np.inf),
+            ("thompson", 1.0),
+        ]:
+            func = get_allocation_function(func_type, B, randomvars)
+            scalar = scalar_allocation(func_type, B, randomvars)
+            prob = func(mean=mean, var=var)
+
+            self.assertEqual(prob.shape, mean.shape)
+            for i, j in np.ndindex(mean.shape):
+                expected = scalar(mean[i, j], var[i, j])
+                self.assertAlmostEqual(prob[i, j], expected, places=12)
+                self.assertAlmostEqual(
+                    func(mean=mean[i, j], var=var[i, j]), expected, places=12
+                )
+
+    def test_fixed_values(self):
+        """Probabilities of a few posteriors with known values"""
+        randomvars = np.array([-1.0, 0.0, 1.0, 2.0])
+
+        thompson = get_allocation_function("thompson", 1.0, randomvars)
+        np.testing.assert_allclose(
+            thompson(mean=np.array([0.0, 1.0]), var=np.array([1.0, 1.0])),
+            [0.5, stats.norm.cdf(1.0)],
+        )
+
+        # Samples -1.5, -0.5, 0.5, 1.5 and 0, 1, 2, 3
+        step = get_allocation_function("smooth", np.inf, randomvars)
+        np.testing.assert_allclose(
+            step(mean=np.array([-0.5, 1.0]), var=np.array([1.0, 1.0])), [0.5, 0.8]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
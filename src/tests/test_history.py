@@ -0,0 +1,108 @@
+# src/tests/test_history.py
+
+import unittest
+
+import numpy as np
+
+from src.algorithm.history import UserHistoryStore
+
+
+def append_rows(store, user_id, rows, rng):
+    """Append random decision points for a user, return their design rows and rewards"""
+    design = rng.normal(size=(rows, store.num_params))
+    rewards = rng.integers(0, 4, size=rows).astype(float)
+    for j in range(rows):
+        store.append(
+            user_id,
+            list(rng.integers(0, 2, size=3)),
+            int(rng.integers(0, 2)),
+            0.5,
+            design[j],
+            j,
+            rewards[j - 1] if j > 0 else 0.0,
+        )
+    return design, rewards
+
+
+class TestUserHistoryStore(unittest.TestCase):
+    """Tests for the columnar user history store"""
+
+    def test_growth_keeps_rows_and_statistics(self):
+        """Doubling the capacities keeps the rows, and the statistics match"""
+        rng = np.random.default_rng(0)
+        store = UserHistoryStore(num_params=4, user_capacity=2, row_capacity=2)
+
+        expected = {}
+        for user in range(5):
+            expected[f"u{user}"] = append_rows(store, f"u{user}", 3 + 2 * user, rng)
+
+        self.assertEqual(store.user_ids, [f"u{user}" for user in range(5)])
+        self.assertEqual(store.user_capacity, 8)
+        self.assertEqual(store.row_capacity, 16)
+
+        for user_id, (design, rewards) in expected.items():
+            # The last row has not received its reward yet
+            X = design[:-1]
+            y = rewards[:-1]
+            np.testing.assert_array_equal(store.field(user_id, "design"), design)
+            np.testing.assert_array_equal(store.design_matrix(user_id), X)
+            np.testing.assert_array_equal(store.rewards(user_id), y)
+            np.testing.assert_array_equal(
+                store.decision_indices(user_id), np.arange(len(y))
+            )
+
+            stats = store.statistics(user_id)
+            self.assertEqual(stats["num_ts"], len(y))
+            np.testing.assert_allclose(stats["xtx"], X.T @ X)
+            np.testing.assert_allclose(stats["xty"], X.T @ y)
+            self.assertAlmostEqual(stats["sum_sq_reward"], y @ y)
+
+    def test_views_are_zero_copy(self):
+        """Design matrices and rewards are views of the store's arrays"""
+        store = UserHistoryStore(num_params=4)
+        append_rows(store, "u0", 5, np.random.default_rng(1))
+
+        self.assertTrue(
+            np.shares_memory(store.design_matrix("u0"), store.rows["design"])
+        )
+        self.assertTrue(np.shares_memory(store.rewards("u0"), store.rows["reward"]))
+        self.assertIn("u0", store)
+        self.assertNotIn("u1", store)
+
+    def test_extend_matches_append(self):
+        """Appending a block of rows is the same as appending them one by one"""
+        rng = np.random.default_rng(2)
+        rows = 7
+        states = rng.integers(0, 2, size=(rows, 3)).astype(float)
+        actions = rng.integers(0, 2, size=rows)
+        design = rng.normal(size=(rows, 4))
+        rewards = rng.integers(0, 4, size=rows).astype(float)
+
+        one = UserHistoryStore(num_params=4, row_capacity=2)
+        block = UserHistoryStore(num_params=4, row_capacity=2)
+        for j in range(rows):
+            one.append("u0", states[j], actions[j], 0.5, design[j], j, rewards[j])
+
+        # Split the rows in two blocks, the second continues the first
+        block.extend(
+            "u0", states[:3], actions[:3], 0.5, design[:3], np.arange(3), rewards[:3]
+        )
+        rewarded = block.extend(
+            "u0",
+            states[3:],
+            actions[3:],
+            0.5,
+            design[3:],
+            np.arange(3, rows),
+            rewards[3:],
+        )
+        self.assertEqual(rewarded, rows - 3)
+
+        for key in ["state", "action", "reward", "design", "decision_index"]:
+            np.testing.assert_array_equal(block.field("u0", key), one.field("u0", key))
+        for key, value in one.statistics("u0").items():
+            np.testing.assert_allclose(block.statistics("u0")[key], value)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,817 @@
+# src/tests/test_mixed_effects.py
+
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src.algorithm.mixed_effects import (
+    advantage_features,
+    gradient_descent,
+    MixedEffectsAlgorithm,
+    obj_value_and_analytic_grad,
+    obj_value_and_grad,
+    ObjectiveCache,
+    pad_users,
+    STATE_SPACE,
+    validate_objective,
+)
+from src.algorithm.posterior import block_posterior, user_factors
+from src.algorithm.smooth_allocation import get_allocation_function
+
+
+class AlgorithmTestCase(unittest.TestCase):
+    """Builds small mixed effects algorithms and feeds them decision points"""
+
+    def setUp(self):
+        self.logger_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Every algorithm adds a file handler to the shared logger
+        logger = logging.getLogger("MixedEffects")
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        shutil.rmtree(self.logger_path)
+
+    def make_algorithm(self, **kwargs) -> MixedEffectsAlgorithm:
+        """Algorithm with a population prior around 0 and thompson sampling"""
+        size = 24
+        kwargs.setdefault("max_iter", 30)
+        return MixedEffectsAlgorithm(
+            num_days=30,
+            prior_mean=np.zeros(size),
+            prior_cov=0.5 * np.identity(size),
+            init_cov_u=0.01 * np.identity(size),
+            init_noise_var=0.85,
+            alloc_func=get_allocation_function("thompson", 1.0, None),
+            rng=np.random.default_rng(0),
+            logger_path=self.logger_path,
+            **kwargs,
+        )
+
+    @staticmethod
+    def add_decisions(algorithm, users, decisions, seed=0, start=0):
+        """Add decision points with random states, actions and rewards"""
+        rng = np.random.default_rng(seed)
+        for t in range(start, start + decisions):
+            for user_id in users:
+                algorithm.update_design_row(
+                    user_id,
+                    list(rng.integers(0, 2, size=3)),
+                    int(rng.integers(0, 2)),
+                    0.5,
+                    float(rng.integers(0, 4)),
+                    t,
+                )
+
+    def assert_matches_fresh_posterior(self, algorithm):
+        """The published posterior matches one computed from scratch"""
+        A_hat, B_hat, _, _, user_list = algorithm.create_A_B_matrix()
+        expected = block_posterior(
+            algorithm.prior_mean,
+            algorithm.prior_cov,
+            algorithm.sigma_u,
+            algorithm.noise_var,
+            A_hat,
+            B_hat,
+        )
+        state = algorithm.posterior_state
+
+        self.assertEqual(algorithm.last_update_users_list, user_list)
+        np.testing.assert_allclose(state.mean, expected.mean, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(
+            state.cov_blocks, expected.cov_blocks, rtol=1e-10, atol=1e-12
+        )
+        np.testing.assert_allclose(
+            state.theta_pop_mean, expected.theta_pop_mean, rtol=1e-10, atol=1e-12
+        )
+
+
+class TestDirtyUserUpdates(AlgorithmTestCase):
+    """Tests for the factorizations cached between posterior updates"""
+
+    def test_only_users_with_new_data_are_recomputed(self):
+        """Cached updates match a fresh posterior, recomputing only new data"""
+        algorithm = self.make_algorithm()
+        users = ["u0", "u1", "u2", "u3"]
+        self.add_decisions(algorithm, users, 5)
+
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 4)
+        self.assert_matches_fresh_posterior(algorithm)
+
+        # New data for some of the users, and a new user
+        self.add_decisions(algorithm, ["u1", "u3"], 3, seed=1, start=5)
+        self.add_decisions(algorithm, ["u4"], 3, seed=2)
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users"], 5)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 3)
+        self.assert_matches_fresh_posterior(algorithm)
+
+        # No new data at all
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 0)
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_hyperparameter_swap_uses_staged_factors(self):
+        """After a fit only the users with data since the fit are recomputed"""
+        algorithm = self.make_algorithm()
+        users = ["u0", "u1", "u2"]
+        self.add_decisions(algorithm, users, 6)
+        algorithm.update_posteriors(None)
+
+        algorithm.update_hyperparameters(1, None)
+        self.assertTrue(algorithm.last_fit_report["valid"])
+        self.assertEqual(set(algorithm.factor_cache_pending), set(users))
+
+        self.add_decisions(algorithm, ["u0"], 2, seed=1, start=6)
+        with mock.patch.object(
+            algorithm.factor_pool,
+            "user_factors",
+            wraps=algorithm.factor_pool.user_factors,
+        ) as spy:
+            algorithm.update_posteriors(None)
+
+        # Only u0 is factorized, at the applied hyperparameters
+        self.assertEqual(spy.call_count, 1)
+        sigma_u, noise_var, A_hat, B_hat = spy.call_args.args
+        np.testing.assert_array_equal(sigma_u, algorithm.sigma_u_pending)
+        self.assertEqual(noise_var, algorithm.noise_var_pending)
+        self.assertEqual(len(A_hat), 1)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 1)
+        self.assertEqual(algorithm.factor_cache_pending, {})
+        np.testing.assert_array_equal(algorithm.sigma_u, algorithm.sigma_u_pending)
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_staged_factors_without_new_data(self):
+        """Applying a fit to unchanged users doesn't factorize them again"""
+        algorithm = self.make_algorithm()
+        users = ["u0", "u1", "u2"]
+        self.add_decisions(algorithm, users, 6)
+        algorithm.update_posteriors(None)
+        algorithm.update_hyperparameters(1, None)
+
+        # The staged factors are those of the fitted hyperparameters
+        A_hat, B_hat, _, _, user_list = algorithm.create_A_B_matrix()
+        expected = user_factors(
+            algorithm.sigma_u_pending, algorithm.noise_var_pending, A_hat, B_hat
+        )
+        for idx, user_id in enumerate(user_list):
+            num_ts, factors = algorithm.factor_cache_pending[user_id]
+            self.assertEqual(num_ts, 5)
+            for key, value in expected.items():
+                np.testing.assert_allclose(factors[key], value[idx], rtol=1e-12)
+
+        with mock.patch.object(
+            algorithm.factor_pool,
+            "user_factors",
+            wraps=algorithm.factor_pool.user_factors,
+        ) as spy:
+            algorithm.update_posteriors(None)
+        self.assertEqual(spy.call_count, 0)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 0)
+        self.assertEqual(algorithm.last_hyperparam_update_id, 1)
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_approximate_fit_stages_no_factors(self):
+        """A fit on part of the data leaves every user to the posterior update"""
+        algorithm = self.make_algorithm(fit_window=3)
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 6)
+        algorithm.update_posteriors(None)
+        algorithm.update_hyperparameters(1, None)
+        self.assertTrue(algorithm.hyperparam_update_flag)
+        self.assertEqual(algorithm.factor_cache_pending, {})
+
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 3)
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_data_during_update_stays_dirty(self):
+        """A user with new data while the statistics are read stays marked"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 4)
+        algorithm.update_posteriors(None)
+
+        create_A_B_matrix = algorithm.create_A_B_matrix
+
+        def concurrent_design_row():
+            self.add_decisions(algorithm, ["u1"], 2, seed=1, start=4)
+            return create_A_B_matrix()
+
+        with mock.patch.object(
+            algorithm, "create_A_B_matrix", side_effect=concurrent_design_row
+        ):
+            algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.dirty_users, {"u1"})
+
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 1)
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_failed_update_keeps_users_dirty(self):
+        """Users of a failed update are recomputed by the next one"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 4)
+        algorithm.update_posteriors(None)
+
+        self.add_decisions(algorithm, ["u1"], 2, seed=1, start=4)
+        with mock.patch.object(
+            algorithm.factor_pool, "user_factors", side_effect=RuntimeError
+        ):
+            status, _, policyid, _, code, _, _ = algorithm.update(None)
+        self.assertFalse(status)
+        self.assertEqual(code, 404)
+        self.assertEqual(algorithm.dirty_users, {"u1"})
+
+        # Failing after the factorizations were cached
+        self.add_decisions(algorithm, ["u2"], 2, seed=2, start=4)
+        with mock.patch(
+            "src.algorithm.mixed_effects.block_posterior", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.dirty_users, {"u1", "u2"})
+        self.assertEqual(algorithm.policyid, policyid)
+
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 2)
+        self.assertEqual(algorithm.dirty_users, set())
+        self.assert_matches_fresh_posterior(algorithm)
+
+    def test_rejected_fit_keeps_hyperparameters(self):
+        """A fit which fails validation leaves the cache and hyperparameters"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 4)
+        algorithm.update_posteriors(None)
+        sigma_u = algorithm.sigma_u
+
+        fit = algorithm.fit_hyperparameters
+        with mock.patch.object(
+            algorithm,
+            "fit_hyperparameters",
+            side_effect=lambda *args, **kwargs: dict(fit(*args, **kwargs), valid=False),
+        ):
+            algorithm.update_hyperparameters(1, None)
+        self.assertFalse(algorithm.last_fit_report["valid"])
+        self.assertFalse(algorithm.hyperparam_update_flag)
+        self.assertEqual(algorithm.factor_cache_pending, {})
+
+        self.add_decisions(algorithm, ["u2"], 2, seed=1, start=4)
+        algorithm.update_posteriors(None)
+
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 1)
+        np.testing.assert_array_equal(algorithm.sigma_u, sigma_u)
+        self.assert_matches_fresh_posterior(algorithm)
+
+
+class TestOnlineUpdate(AlgorithmTestCase):
+    """Tests for the online rank-one refresh between batch updates"""
+
+    def test_refresh_only_changes_the_user(self):
+        """A new design row refreshes the user's probabilities, and only those"""
+        algorithm = self.make_algorithm(online_update=True)
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 5)
+        algorithm.update_posteriors(None)
+        published = algorithm.snapshot
+
+        self.add_decisions(algorithm, ["u1"], 2, seed=1, start=5)
+        snapshot = algorithm.snapshot
+
+        self.assertEqual(snapshot.policyid, published.policyid)
+        self.assertEqual(set(snapshot.overrides), {1})
+        self.assertIs(snapshot.prob_table, published.prob_table)
+        self.assertIs(snapshot.beta_cov, published.beta_cov)
+
+        # The refreshed row matches the probabilities of the refreshed posterior
+        mean, cov = snapshot.advantage_block(1)
+        expected = algorithm.action_probabilities(
+            advantage_features(STATE_SPACE, 8), mean[None], cov[None], ["u1"]
+        )[0]
+        np.testing.assert_array_equal(snapshot.prob_row(1), expected)
+        np.testing.assert_array_equal(snapshot.prob_row(0), published.prob_row(0))
+        self.assertFalse(np.allclose(snapshot.prob_row(1), published.prob_row(1)))
+
+        _, _, act_prob, _ = algorithm.get_action("u1", [1, 0, 1], 7, seed=3)
+        self.assertEqual(act_prob, algorithm.clip_prob(expected[5]))
+
+        # The batch update replaces the refreshed rows
+        algorithm.update_posteriors(None)
+        self.assertEqual(algorithm.snapshot.overrides, {})
+        self.assert_matches_fresh_posterior(algorithm)
+
+
+class TestProbabilityTable(AlgorithmTestCase):
+    """Tests for the probability table published with each policy"""
+
+    def computed_rows(self, algorithm, update):
+        """Users whose probabilities are computed by an update"""
+        users = []
+        compute = algorithm.action_probabilities
+
+        def spy(features, beta_mean, beta_cov, user_ids, **kwargs):
+            users.extend(user_ids)
+            return compute(features, beta_mean, beta_cov, user_ids, **kwargs)
+
+        with mock.patch.object(algorithm, "action_probabilities", side_effect=spy):
+            update()
+        return users
+
+    def test_batch_publish_recomputes_every_row(self):
+        """Rows of users without new data follow the new theta pop"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2", "u3"], 4)
+        algorithm.update_posteriors(None)
+        previous = algorithm.snapshot
+
+        # New data for u1 and new users, which move theta pop
+        self.add_decisions(algorithm, ["u1"], 2, seed=1, start=4)
+        self.add_decisions(algorithm, ["u4", "u5", "u6"], 4, seed=2)
+        computed = self.computed_rows(
+            algorithm, lambda: algorithm.update_posteriors(None)
+        )
+        snapshot = algorithm.snapshot
+        self.assertEqual(computed, snapshot.user_list + [None])
+        np.testing.assert_array_equal(
+            snapshot.prob_table, algorithm.probability_table(snapshot)
+        )
+
+        # The users without new data have new probabilities too
+        row = snapshot.user_index["u0"]
+        self.assertFalse(
+            np.array_equal(snapshot.prob_table[row], previous.prob_table[row])
+        )
+
+    def test_online_refresh_recomputes_one_row(self):
+        """An online refresh only computes the refreshed user's row"""
+        algorithm = self.make_algorithm(online_update=True)
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 4)
+        algorithm.update_posteriors(None)
+        previous = algorithm.snapshot
+
+        computed = self.computed_rows(
+            algorithm,
+            lambda: algorithm.update_design_row("u1", [1, 0, 1], 1, 0.5, 2.0, 4),
+        )
+        self.assertEqual(computed, ["u1"])
+
+        snapshot = algorithm.snapshot
+        row = snapshot.user_index["u1"]
+        self.assertIs(snapshot.prob_table, previous.prob_table)
+        fresh = algorithm.action_probabilities(
+            advantage_features(STATE_SPACE, snapshot.adv_size),
+            *[block[None] for block in snapshot.advantage_block(row)],
+            ["u1"],
+        )
+        np.testing.assert_array_equal(snapshot.prob_row(row), fresh[0])
+
+    def test_hyperparameter_swap_recomputes_all_rows(self):
+        """New hyperparameters change every user's probabilities"""
+        algorithm = self.make_algorithm()
+        users = ["u0", "u1", "u2"]
+        self.add_decisions(algorithm, users, 6)
+        algorithm.update_posteriors(None)
+        algorithm.update_hyperparameters(1, None)
+
+        computed = self.computed_rows(
+            algorithm, lambda: algorithm.update_posteriors(None)
+        )
+        self.assertEqual(algorithm.last_update_report["num_users_recomputed"], 0)
+        self.assertEqual(computed, users + [None])
+        np.testing.assert_array_equal(
+            algorithm.snapshot.prob_table,
+            algorithm.probability_table(algorithm.snapshot),
+        )
+
+
+class TestWarmStart(AlgorithmTestCase):
+    """Tests for the warm started hyperparameter fits and their telemetry"""
+
+    def fit_start(self, algorithm, request_id):
+        """Fit the hyperparameters, return the point the optimizer started from"""
+        fit = algorithm.fit_hyperparameters
+        with mock.patch.object(
+            algorithm, "fit_hyperparameters", side_effect=fit
+        ) as spy:
+            algorithm.update_hyperparameters(request_id, None)
+        ltu_flat, noise_var = spy.call_args.args[:2]
+        return np.asarray(ltu_flat), noise_var
+
+    def test_start_selection_order(self):
+        """Fits start from the pending, then the current, then the initial point"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 6)
+
+        # Nothing fit yet, the current hyperparameters are the initial ones
+        ltu_flat, noise_var = self.fit_start(algorithm, 1)
+        self.assertEqual(algorithm.last_fit_report["start"], "current")
+        np.testing.assert_array_equal(ltu_flat, algorithm.init_ltu_flat)
+        self.assertEqual(noise_var, algorithm.init_noise_var)
+        self.assertTrue(algorithm.hyperparam_update_flag)
+
+        # The staged hyperparameters haven't been applied yet
+        pending = (algorithm.ltu_flat_pending, algorithm.noise_var_pending)
+        ltu_flat, noise_var = self.fit_start(algorithm, 2)
+        self.assertEqual(algorithm.last_fit_report["start"], "pending")
+        np.testing.assert_array_equal(ltu_flat, pending[0])
+        self.assertEqual(noise_var, pending[1])
+
+        # Once applied, the next fit starts from them
+        algorithm.update_posteriors(None)
+        ltu_flat, noise_var = self.fit_start(algorithm, 3)
+        self.assertEqual(algorithm.last_fit_report["start"], "current")
+        np.testing.assert_array_equal(ltu_flat, algorithm.ltu_flat)
+        self.assertEqual(noise_var, algorithm.noise_var)
+
+        algorithm.warm_start = False
+        ltu_flat, noise_var = self.fit_start(algorithm, 4)
+        self.assertEqual(algorithm.last_fit_report["start"], "init")
+        np.testing.assert_array_equal(ltu_flat, algorithm.init_ltu_flat)
+
+    def test_invalid_warm_start_falls_back_to_init(self):
+        """A warm start which fails validation is reported as an initial start"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 6)
+
+        # A singular Sigma_u fails the checks
+        algorithm.ltu_flat = np.zeros_like(algorithm.ltu_flat)
+        for optimizer in ["gd", "lbfgs"]:
+            algorithm.optimizer = optimizer
+            algorithm.hyperparam_update_flag = False
+            self.fit_start(algorithm, 1)
+
+            report = algorithm.last_fit_report
+            self.assertEqual(report["start"], "init")
+            self.assertTrue(report["valid"])
+            self.assertTrue(algorithm.hyperparam_update_flag)
+
+    def test_failed_fit_clears_report(self):
+        """A fit which fails before reporting leaves no report of an earlier one"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 6)
+        algorithm.update_hyperparameters(1, None)
+        self.assertEqual(algorithm.last_fit_report["request_id"], 1)
+
+        with mock.patch.object(
+            algorithm, "fit_hyperparameters", side_effect=RuntimeError
+        ):
+            status, *_ = algorithm.update(
+                None, update_posterior=False, update_hyperparam=True, request_id=2
+            )
+        self.assertFalse(status)
+        self.assertEqual(algorithm.last_fit_report, {})
+
+    def test_fit_report(self):
+        """The fit report has the telemetry fields, and can be stored as JSON"""
+        algorithm = self.make_algorithm()
+        self.add_decisions(algorithm, ["u0", "u1", "u2"], 6)
+        algorithm.update_hyperparameters(7, None)
+
+        report = algorithm.last_fit_report
+        self.assertEqual(
+            set(report),
+            {
+                "request_id",
+                "optimizer",
+                "start",
+                "num_starts",
+                "valid",
+                "failed_checks",
+                "num_users",
+                "approximation",
+                "iterations",
+                "evaluations",
+                "restarts",
+                "objective",
+                "grad_norm",
+                "wall_time",
+                "objective_cache",
+            },
+        )
+        self.assertEqual(report["request_id"], 7)
+        self.assertEqual(report["optimizer"], "gd")
+        self.assertEqual(report["num_starts"], 1)
+        self.assertEqual(report["num_users"], 3)
+        self.assertEqual(report["failed_checks"], [])
+        self.assertEqual(report["approximation"]["mode"], "full")
+        self.assertGreater(report["iterations"], 0)
+        self.assertGreaterEqual(report["evaluations"], report["iterations"])
+        self.assertGreater(report["wall_time"], 0)
+        self.assertTrue(np.isfinite(report["objective"]))
+        self.assertTrue(np.isfinite(report["grad_norm"]))
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+
+class TestWarmUp(AlgorithmTestCase):
+    """Tests for compiling the hyperparameter fit ahead of the requests"""
+
+    COMPILED = [
+        gradient_descent,
+        obj_value_and_grad,
+        obj_value_and_analytic_grad,
+        validate_objective,
+    ]
+
+    def compiled(self):
+        return [func._cache_size() for func in self.COMPILED]
+
+    def test_fits_after_warm_up_do_not_compile(self):
+        """Single, multi-start, minibatch and rejected fits reuse the warm-up"""
+        configs = [
+            {},
+            {"num_starts": 3, "halving_rounds": 2},
+            {"fit_minibatch": 2, "fit_epochs": 2},
+            {"gradient": "analytic", "fit_minibatch": 4},
+            {"optimizer": "lbfgs", "num_starts": 2},
+        ]
+        for config in configs:
+            algorithm = self.make_algorithm(min_bucket=4, **config)
+            self.add_decisions(algorithm, ["u{}".format(i) for i in range(6)], 6)
+            algorithm.warm_up(6)
+
+            compiled = self.compiled()
+            algorithm.update_hyperparameters(1, None)
+
+            fit = algorithm.fit_hyperparameters
+            with mock.patch.object(
+                algorithm,
+                "fit_hyperparameters",
+                side_effect=lambda *args, **kwargs: dict(
+                    fit(*args, **kwargs), valid=False
+                ),
+            ):
+                algorithm.num_starts = 1
+                algorithm.fit_minibatch = None
+                algorithm.update_hyperparameters(2, None)
+            self.assertFalse(algorithm.last_fit_report["valid"])
+
+            self.assertEqual(self.compiled(), compiled, config)
+
+    def test_warm_up_leaves_objective_cache(self):
+        """The warm-up doesn't evaluate into the cache of the live fits"""
+        algorithm = self.make_algorithm(optimizer="lbfgs")
+        algorithm.warm_up(20)
+        self.assertEqual(
+            algorithm.objective_cache.stats(), {"hits": 0, "misses": 0, "size": 0}
+        )
+
+    def test_objective_cache_is_thread_safe(self):
+        """Concurrent lookups keep the counters and the size bound consistent"""
+        cache = ObjectiveCache(maxsize=8)
+        version = ObjectiveCache.data_version(np.ones(3))
+
+        def lookups(seed):
+            rng = np.random.default_rng(seed)
+            for x in rng.integers(0, 16, size=500):
+                cache.lookup("value", np.array([x]), version, lambda: float(x))
+
+        threads = [threading.Thread(target=lookups, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 2000)
+        self.assertLessEqual(stats["size"], 8)
+
+
+class TestMultiStart(AlgorithmTestCase):
+    """Tests for the multi-start hyperparameter search"""
+
+    def test_start_points(self):
+        """The warm start and the initial point come first, the jitter is seeded"""
+        algorithm = self.make_algorithm(num_starts=5, start_jitter=0.2)
+        ltu_flat = 2 * algorithm.init_ltu_flat
+
+        starts = algorithm.multi_start_points("current", ltu_flat, 0.5, 3)
+        self.assertEqual(
+            list(starts), ["current", "init", "jitter_0", "jitter_1", "jitter_2"]
+        )
+        np.testing.assert_array_equal(starts["current"][0], ltu_flat)
+        self.assertEqual(starts["current"][1], 0.5)
+        np.testing.assert_array_equal(starts["init"][0], algorithm.init_ltu_flat)
+        self.assertEqual(starts["init"][1], algorithm.init_noise_var)
+
+        # Jittered copies of the warm start, with positive scales
+        for name in ["jitter_0", "jitter_1", "jitter_2"]:
+            jitter_ltu_flat, noise_var = starts[name]
+            self.assertFalse(np.allclose(jitter_ltu_flat, ltu_flat))
+            self.assertTrue(np.all(np.sign(jitter_ltu_flat) == np.sign(ltu_flat)))
+            self.assertGreater(noise_var, 0)
+
+        # Reproducible for the same request, different for another
+        again = algorithm.multi_start_points("current", ltu_flat, 0.5, 3)
+        other = algorithm.multi_start_points("current", ltu_flat, 0.5, 4)
+        for name in starts:
+            np.testing.assert_array_equal(again[name][0], starts[name][0])
+            self.assertEqual(again[name][1], starts[name][1])
+        self.assertFalse(np.allclose(other["jitter_0"][0], starts["jitter_0"][0]))
+
+        algorithm.num_starts = 1
+        self.assertEqual(
+            list(algorithm.multi_start_points("pending", ltu_flat, 0.5, 3)),
+            ["pending"],
+        )
+
+    def fake_fits(self, objectives):
+        """
+        Stand-in for run_optimizer, each start (keyed by its noise variance)
+        stays where it is and improves its objective by 1 every round.
+        Objectives of None are invalid fits
+        """
+        calls = []
+
+        def run_optimizer(*args):
+            ltu_flat, noise_var, budget = args[1], args[2], args[14]
+            calls.append(noise_var)
+            objective = objectives[noise_var]
+            if objective is not None:
+                objective -= calls.count(noise_var)
+            return {
+                "ltu_flat": ltu_flat,
+                "noise_precision": 1.0 / noise_var,
+                "objective": 100000.0 if objective is None else objective,
+                "valid": objective is not None,
+                "start_valid": True,
+                "num_iter": budget,
+                "num_evals": budget + 2,
+                "num_restarts": 0,
+                "grad_norm": 1.0,
+            }
+
+        return run_optimizer, calls
+
+    def multi_start_fit(self, algorithm, starts, objectives):
+        run_optimizer, calls = self.fake_fits(objectives)
+        size = algorithm.sigma_u.shape[0]
+        with mock.patch(
+            "src.algorithm.mixed_effects.run_optimizer", side_effect=run_optimizer
+        ):
+            result, name = algorithm.multi_start_fit(
+                starts,
+                np.zeros((4, size, size)),
+                np.zeros((4, size)),
+                np.ones(4),
+                1.0,
+                10,
+            )
+        return result, name, calls
+
+    def test_successive_halving(self):
+        """Every round keeps the better half of the valid starts"""
+        algorithm = self.make_algorithm(max_iter=30, halving_rounds=3)
+        ltu_flat = algorithm.init_ltu_flat
+        starts = {
+            "current": (ltu_flat, 1.0),
+            "init": (ltu_flat, 2.0),
+            "jitter_0": (ltu_flat, 3.0),
+            "jitter_1": (ltu_flat, 4.0),
+            "jitter_2": (ltu_flat, 5.0),
+        }
+        # The lowest objective is not valid
+        objectives = {1.0: None, 2.0: 30.0, 3.0: 10.0, 4.0: 20.0, 5.0: 40.0}
+
+        result, name, calls = self.multi_start_fit(algorithm, starts, objectives)
+
+        # All starts, then the best two valid ones, then the best one
+        self.assertEqual(calls, [1.0, 2.0, 3.0, 4.0, 5.0, 3.0, 4.0, 3.0])
+        self.assertEqual(name, "jitter_0")
+        self.assertTrue(result["valid"])
+        self.assertEqual(result["objective"], 7.0)
+        self.assertEqual(result["noise_precision"], 1.0 / 3.0)
+        self.assertEqual(result["num_iter"], 8 * 10)
+        self.assertEqual(result["num_evals"], 8 * 12)
+
+    def test_best_valid_start(self):
+        """The best valid start wins, and all starts failing gives no valid fit"""
+        algorithm = self.make_algorithm(max_iter=20, halving_rounds=2)
+        ltu_flat = algorithm.init_ltu_flat
+        starts = {"current": (ltu_flat, 1.0), "init": (ltu_flat, 2.0)}
+
+        result, name, calls = self.multi_start_fit(
+            algorithm, starts, {1.0: None, 2.0: 50.0}
+        )
+        self.assertEqual(name, "init")
+        self.assertTrue(result["valid"])
+        self.assertEqual(result["objective"], 48.0)
+
+        result, name, calls = self.multi_start_fit(
+            algorithm, starts, {1.0: None, 2.0: None}
+        )
+        self.assertEqual(calls, [1.0, 2.0])
+        self.assertEqual(name, "current")
+        self.assertFalse(result["valid"])
+
+    def test_multi_start_update(self):
+        """A multi-start fit reports the winning start and stages a valid fit"""
+        algorithm = self.make_algorithm(num_starts=3, halving_rounds=2)
+        self.add_decisions(algorithm, ["u0", "u1", "u2", "u3"], 6)
+        algorithm.update_hyperparameters(5, None)
+
+        report = algorithm.last_fit_report
+        self.assertTrue(report["valid"])
+        self.assertEqual(report["num_starts"], 3)
+        self.assertIn(report["start"], ["current", "init", "jitter_0"])
+        self.assertTrue(algorithm.hyperparam_update_flag)
+
+
+class TestFitApproximation(AlgorithmTestCase):
+    """Tests for the windowed and minibatch hyperparameter fits"""
+
+    def test_window_of_users_at_different_stages(self):
+        """Each user is windowed on their own latest decision points"""
+        algorithm = self.make_algorithm(fit_window=14)
+        self.add_decisions(algorithm, ["veteran"], 60)
+        self.add_decisions(algorithm, ["recruit"], 10, seed=1)
+
+        stats = algorithm.fit_statistics(1)
+        self.assertEqual(stats["user_list"], ["veteran", "recruit"])
+
+        # The reward of each user's last decision point hasn't arrived yet
+        history = algorithm.history
+        for k, (user_id, fit) in enumerate(
+            [("veteran", range(45, 59)), ("recruit", range(0, 9))]
+        ):
+            keep = np.isin(history.decision_indices(user_id), list(fit))
+            rows = history.design_matrix(user_id)[keep]
+            rewards = history.rewards(user_id)[keep]
+            np.testing.assert_allclose(stats["A_hat"][k], rows.T @ rows)
+            np.testing.assert_allclose(stats["B_hat"][k], rows.T @ rewards)
+            self.assertEqual(stats["user_sum_sq_reward"][k], rewards @ rewards)
+            self.assertEqual(stats["user_num_ts"][k], len(fit))
+
+        approximation = stats["approximation"]
+        self.assertEqual(approximation["mode"], "window")
+        self.assertEqual(approximation["users_total"], 2)
+        self.assertEqual(approximation["users_fit"], 2)
+        self.assertEqual(approximation["observations_total"], 59 + 9)
+        self.assertEqual(approximation["observations_fit"], 14 + 9)
+
+        algorithm.update_hyperparameters(1, None)
+        self.assertEqual(algorithm.last_fit_report["approximation"], approximation)
+        self.assertEqual(algorithm.last_fit_report["num_users"], 2)
+
+    def test_minibatch_fit(self):
+        """Minibatch steps share the budget and are checked on all users"""
+        algorithm = self.make_algorithm(fit_minibatch=2, fit_epochs=2, max_iter=24)
+        users = ["u0", "u1", "u2", "u3", "u4"]
+        self.add_decisions(algorithm, users, 6)
+
+        calls = []
+        fit = algorithm.fit_hyperparameters
+
+        def spy(*args, **kwargs):
+            calls.append((args[4], args[5], args[6], kwargs["max_iter"]))
+            return fit(*args, **kwargs)
+
+        with mock.patch.object(algorithm, "fit_hyperparameters", side_effect=spy):
+            algorithm.update_hyperparameters(3, None)
+
+        # 3 minibatches of at most 2 users in each of the 2 epochs
+        stats = algorithm.fit_statistics(3)
+        self.assertEqual(len(calls), 6)
+        for user_weights, sum_sq_reward, total_ts, max_iter in calls:
+            self.assertEqual(max_iter, 24 // 6)
+            self.assertLessEqual(np.count_nonzero(user_weights), 2)
+            # Each minibatch is scaled up to all the users
+            self.assertAlmostEqual(user_weights.sum(), len(users))
+            self.assertGreater(sum_sq_reward, 0)
+            self.assertGreater(total_ts, 0)
+
+        report = algorithm.last_fit_report
+        self.assertEqual(report["approximation"]["mode"], "minibatch")
+        self.assertEqual(report["approximation"]["minibatch"], 2)
+        self.assertEqual(report["num_starts"], 1)
+        self.assertTrue(report["valid"])
+
+        # The reported objective is that of all users at the staged point
+        A_pad, B_pad, user_weights = pad_users(stats["A_hat"], stats["B_hat"])
+        (objective, valid), _ = obj_value_and_grad(
+            algorithm.ltu_flat_pending,
+            1.0 / algorithm.noise_var_pending,
+            A_pad,
+            B_pad,
+            user_weights,
+            algorithm.prior_mean,
+            algorithm.prior_cov,
+            float(stats["user_sum_sq_reward"].sum()),
+            int(stats["user_num_ts"].sum()),
+        )
+        self.assertTrue(valid)
+        self.assertAlmostEqual(report["objective"], float(objective), places=8)
+
+        # The minibatches are shuffled with the request id
+        staged = algorithm.ltu_flat_pending
+        algorithm.hyperparam_update_flag = False
+        algorithm.update_hyperparameters(3, None)
+        np.testing.assert_array_equal(algorithm.ltu_flat_pending, staged)
+
+
+if __name__ == "__main__":
+    unittest.main()
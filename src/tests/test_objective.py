@@ -0,0 +1,453 @@
+# src/tests/test_objective.py
+
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import scipy.linalg as linalg
+
+from src.algorithm.mixed_effects import (
+    bucket_size,
+    failed_checks,
+    gradient_descent,
+    lbfgs,
+    ObjectiveCache,
+    obj_func,
+    obj_value_and_analytic_grad,
+    obj_value_and_grad,
+    pad_users,
+    run_optimizer,
+    stratified_subsample,
+    validate_objective,
+)
+from src.tests.test_posterior import make_problem
+
+
+def dense_objective(
+    ltu_flat, noise_precision, A_hat, B_hat, prior_mean, prior_cov, sum_sq_reward, ts
+):
+    """Reference objective computed with the dense (24N x 24N) matrices"""
+    nusers, size = B_hat.shape
+
+    L = jnp.zeros((size, size)).at[jnp.tril_indices(size)].set(ltu_flat)
+    Sigma_u = L @ L.T
+
+    Sigma_theta = jnp.kron(jnp.ones((nusers, nusers)), prior_cov) + jnp.kron(
+        jnp.identity(nusers), Sigma_u
+    )
+    X = jnp.linalg.inv(Sigma_theta)
+    A = jnp.array(linalg.block_diag(*A_hat))
+    B = B_hat.flatten()
+    mu_prior = jnp.kron(jnp.ones(nusers), prior_mean)
+    y = noise_precision
+
+    part1 = jnp.linalg.slogdet(X)[1]
+    part2 = -jnp.linalg.slogdet(X + y * A)[1]
+    part3 = ts * jnp.log(y)
+    part4 = -y * sum_sq_reward
+    part5 = -mu_prior @ X @ mu_prior
+    part6 = (X @ mu_prior + y * B) @ jnp.linalg.solve(X + y * A, X @ mu_prior + y * B)
+
+    return -1 * (part1 + part2 + part3 + part4 + part5 + part6)
+
+
+class TestObjective(unittest.TestCase):
+    """Tests for the block structured hyperparameter objective"""
+
+    def test_matches_dense_objective(self):
+        """Block objective and gradients match the dense computation"""
+        for nusers in [1, 3]:
+            prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(
+                nusers, seed=nusers
+            )
+            ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+            args = (
+                ltu_flat,
+                1.0 / noise_var,
+                np.array(A_hat),
+                B_hat,
+                np.ones(nusers),
+                prior_mean,
+                prior_cov,
+                float(np.sum(B_hat)),
+                10 * nusers,
+            )
+            dense_args = args[:4] + args[5:]
+
+            expected = dense_objective(*dense_args)
+            expected_grads = jax.grad(dense_objective, argnums=(0, 1))(*dense_args)
+
+            np.testing.assert_allclose(obj_func(*args), expected, rtol=1e-10)
+
+            (value, valid), grads = obj_value_and_grad(*args)
+            self.assertTrue(valid)
+            np.testing.assert_allclose(value, expected, rtol=1e-10)
+            for grad, expected_grad in zip(grads, expected_grads):
+                np.testing.assert_allclose(
+                    grad, expected_grad, atol=1e-8 * np.max(np.abs(expected_grad))
+                )
+
+    def test_ill_conditioned_sigma_u(self):
+        """The objective stays exact for a Sigma_u as badly conditioned as a fit's"""
+        prior_mean, prior_cov, _, noise_var, A_hat, B_hat = make_problem(3, seed=4)
+        size = B_hat.shape[1]
+        rng = np.random.default_rng(4)
+        basis = np.linalg.qr(rng.normal(size=(size, size)))[0]
+        sigma_u = basis @ np.diag(np.logspace(-7.5, -0.5, size)) @ basis.T
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(size)]
+        args = (
+            ltu_flat,
+            1.0 / noise_var,
+            np.array(A_hat),
+            B_hat,
+            np.ones(3),
+            prior_mean,
+            prior_cov,
+            float(np.sum(B_hat)),
+            30,
+        )
+
+        self.assertGreater(np.linalg.cond(sigma_u), 1e6)
+        self.assertEqual(obj_func(*args).dtype, np.float64)
+        np.testing.assert_allclose(
+            obj_func(*args), dense_objective(*args[:4], *args[5:]), rtol=1e-8
+        )
+
+    def test_invalid_sigma_u(self):
+        """A singular random effects covariance is flagged as invalid"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(2)
+        ltu_flat = np.zeros(sigma_u.shape[0] * (sigma_u.shape[0] + 1) // 2)
+
+        (_, valid), _ = obj_value_and_grad(
+            ltu_flat,
+            1.0 / noise_var,
+            np.array(A_hat),
+            B_hat,
+            np.ones(2),
+            prior_mean,
+            prior_cov,
+            1.0,
+            10,
+        )
+        self.assertFalse(valid)
+
+        value, mask = validate_objective(
+            ltu_flat,
+            1.0 / noise_var,
+            np.array(A_hat),
+            B_hat,
+            np.ones(2),
+            prior_mean,
+            prior_cov,
+            1.0,
+            10,
+        )
+        self.assertEqual(value, 100000.0)
+        self.assertEqual(failed_checks(mask)[0], "sigma_u_not_pd")
+
+    def test_validity_mask(self):
+        """The validity mask is 0 for a valid posterior and flags large means"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(3)
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        args = (np.array(A_hat), B_hat, np.ones(3), prior_mean, prior_cov, 1.0, 10)
+
+        value, mask = validate_objective(ltu_flat, 1.0 / noise_var, *args)
+        self.assertEqual(failed_checks(mask), [])
+        np.testing.assert_allclose(
+            value, obj_func(ltu_flat, 1.0 / noise_var, *args), rtol=1e-12
+        )
+
+        args = (np.array(A_hat), 1000 * B_hat) + args[2:]
+        _, mask = validate_objective(ltu_flat, 1.0 / noise_var, *args)
+        self.assertEqual(failed_checks(mask), ["mean_out_of_bounds"])
+
+    def test_padding_does_not_change_objective(self):
+        """Zero padded users with weight 0 leave the objective unchanged"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(5)
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        A_pad, B_pad, user_weights = pad_users(np.array(A_hat), B_hat)
+
+        self.assertEqual(A_pad.shape[0], 16)
+        self.assertEqual(bucket_size(17), 32)
+
+        (value, valid), grads = obj_value_and_grad(
+            ltu_flat,
+            1.0 / noise_var,
+            np.array(A_hat),
+            B_hat,
+            np.ones(5),
+            prior_mean,
+            prior_cov,
+            40.0,
+            50,
+        )
+        (padded_value, padded_valid), padded_grads = obj_value_and_grad(
+            ltu_flat,
+            1.0 / noise_var,
+            A_pad,
+            B_pad,
+            user_weights,
+            prior_mean,
+            prior_cov,
+            40.0,
+            50,
+        )
+
+        self.assertEqual(bool(valid), bool(padded_valid))
+        np.testing.assert_allclose(padded_value, value, rtol=1e-12)
+        for grad, padded_grad in zip(grads, padded_grads):
+            np.testing.assert_allclose(padded_grad, grad, rtol=1e-8, atol=1e-10)
+
+    def test_analytic_gradient_matches_autodiff(self):
+        """Closed form gradients match jax.grad, including weighted users"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(
+            5, seed=2
+        )
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        A_pad, B_pad, user_weights = pad_users(np.array(A_hat), B_hat)
+        user_weights[:5] = [1.0, 2.0, 0.5, 1.0, 3.0]
+        args = (
+            ltu_flat,
+            1.0 / noise_var,
+            A_pad,
+            B_pad,
+            user_weights,
+            prior_mean,
+            prior_cov,
+            300.0,
+            80,
+        )
+
+        (value, valid), grads = obj_value_and_grad(*args)
+        (analytic_value, analytic_valid), analytic_grads = obj_value_and_analytic_grad(
+            *args
+        )
+
+        self.assertEqual(bool(valid), bool(analytic_valid))
+        np.testing.assert_allclose(analytic_value, value, rtol=1e-12)
+        for grad, analytic_grad in zip(grads, analytic_grads):
+            np.testing.assert_allclose(analytic_grad, grad, rtol=1e-8, atol=1e-10)
+
+    def test_gradient_descent_falls_back_to_init(self):
+        """Compiled loop starts from the initial point if the start is invalid"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(4)
+        size = sigma_u.shape[0]
+        init_ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(size)]
+        args = (np.array(A_hat), B_hat, np.ones(len(B_hat)), prior_mean, prior_cov)
+
+        result = gradient_descent(
+            np.zeros_like(init_ltu_flat),
+            1.0 / noise_var,
+            init_ltu_flat,
+            1.0 / noise_var,
+            *args,
+            0.002,
+            0.0001,
+            float(np.sum(B_hat**2)),
+            40,
+            250,
+            10,
+            50,
+        )
+        init_obj = obj_func(
+            init_ltu_flat, 1.0 / noise_var, *args, float(np.sum(B_hat**2)), 40
+        )
+
+        self.assertFalse(result["start_valid"])
+        self.assertTrue(result["valid"])
+        self.assertLessEqual(int(result["num_iter"]), 50)
+        self.assertLessEqual(float(result["objective"]), float(init_obj))
+        np.testing.assert_array_equal(
+            np.isnan(result["trace_objective"]),
+            np.arange(50) >= int(result["num_iter"]),
+        )
+
+    def test_lbfgs_matches_gradient_descent(self):
+        """L-BFGS reaches at least the gradient descent objective"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(
+            6, seed=1
+        )
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        args = (np.array(A_hat), B_hat, np.ones(len(B_hat)), prior_mean, prior_cov)
+
+        descent = gradient_descent(
+            ltu_flat,
+            1.0 / noise_var,
+            ltu_flat,
+            1.0 / noise_var,
+            *args,
+            0.001,
+            1e-6,
+            3000.0,
+            200,
+            250,
+            10,
+            300,
+        )
+        result = lbfgs(
+            ltu_flat,
+            1.0 / noise_var,
+            ltu_flat,
+            1.0 / noise_var,
+            *args,
+            1e-6,
+            3000.0,
+            200,
+            300,
+        )
+
+        self.assertTrue(result["valid"])
+        self.assertLessEqual(result["objective"], float(descent["objective"]))
+        np.testing.assert_allclose(
+            obj_func(result["ltu_flat"], result["noise_precision"], *args, 3000.0, 200),
+            result["objective"],
+            rtol=1e-5,
+        )
+
+    def test_lbfgs_evaluations(self):
+        """L-BFGS reaches the objective of 500 gradient descent steps in a tenth
+        of the evaluations"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(
+            6, seed=1
+        )
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        args = (np.array(A_hat), B_hat, np.ones(len(B_hat)), prior_mean, prior_cov)
+
+        descent = gradient_descent(
+            ltu_flat,
+            1.0 / noise_var,
+            ltu_flat,
+            1.0 / noise_var,
+            *args,
+            0.001,
+            1e-6,
+            3000.0,
+            200,
+            250,
+            10,
+            500,
+        )
+        result = lbfgs(
+            ltu_flat,
+            1.0 / noise_var,
+            ltu_flat,
+            1.0 / noise_var,
+            *args,
+            1e-6,
+            3000.0,
+            200,
+            500,
+        )
+
+        best = np.minimum.accumulate(result["trace_objective"])
+        reached = np.flatnonzero(best <= float(descent["objective"]))[0] + 1
+        self.assertLessEqual(10 * reached, int(descent["num_evals"]))
+
+    def test_stratified_subsample(self):
+        """Every stratum is sampled, and the weights add up to the cohort size"""
+        rng = np.random.default_rng(0)
+        num_ts = rng.integers(1, 120, size=50)
+
+        indices, weights = stratified_subsample(num_ts, 0.3, 4, rng)
+        self.assertEqual(len(np.unique(indices)), len(indices))
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertAlmostEqual(weights.sum(), 50)
+
+        order = np.argsort(num_ts, kind="stable")
+        for stratum in np.array_split(order, 4):
+            in_stratum = np.isin(indices, stratum)
+            self.assertGreater(in_stratum.sum(), 0)
+            self.assertAlmostEqual(weights[in_stratum].sum(), len(stratum))
+
+        # Sampling everyone gives unit weights
+        indices, weights = stratified_subsample(num_ts, 1.0, 4, rng)
+        np.testing.assert_array_equal(indices, np.arange(50))
+        np.testing.assert_array_equal(weights, np.ones(50))
+
+    def test_objective_cache(self):
+        """The cache is keyed by point and data, and evicts the oldest entry"""
+        cache = ObjectiveCache(maxsize=2)
+        version = ObjectiveCache.data_version(np.ones((2, 3)), 1.0)
+        calls = []
+
+        def lookup(x, data_version=version):
+            return cache.lookup(
+                "value", np.array(x), data_version, lambda: calls.append(x) or x
+            )
+
+        lookup([1.0])
+        lookup([2.0])
+        lookup([1.0])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "size": 2})
+
+        # Other data is a different entry, and pushes out the oldest point
+        lookup([1.0], ObjectiveCache.data_version(np.ones((2, 3)), 2.0))
+        lookup([2.0])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 4, "size": 2})
+
+    def test_lbfgs_repeated_fit_hits_cache(self):
+        """A repeated L-BFGS fit on the same data is served from the cache"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(6)
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        A_pad, B_pad, user_weights = pad_users(np.array(A_hat), B_hat)
+        args = (
+            ltu_flat,
+            1.0 / noise_var,
+            ltu_flat,
+            1.0 / noise_var,
+            A_pad,
+            B_pad,
+            user_weights,
+            prior_mean,
+            prior_cov,
+            1e-6,
+            3000.0,
+            200,
+            50,
+        )
+
+        cache = ObjectiveCache()
+        first = lbfgs(*args, cache=cache)
+        misses = cache.misses
+        second = lbfgs(*args, cache=cache)
+
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(cache.hits, second["num_evals"] + first["num_evals"] - misses)
+        self.assertEqual(first["objective"], second["objective"])
+        np.testing.assert_array_equal(first["ltu_flat"], second["ltu_flat"])
+
+    def test_objective_cache_serves_lbfgs(self):
+        """Only L-BFGS evaluates through the cache, gradient descent is compiled"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(4)
+        ltu_flat = np.linalg.cholesky(sigma_u)[np.tril_indices(sigma_u.shape[0])]
+        A_pad, B_pad, user_weights = pad_users(np.array(A_hat), B_hat)
+
+        for optimizer, cached in [("gd", False), ("lbfgs", True)]:
+            cache = ObjectiveCache()
+            result = run_optimizer(
+                optimizer,
+                ltu_flat,
+                noise_var,
+                ltu_flat,
+                noise_var,
+                A_pad,
+                B_pad,
+                user_weights,
+                prior_mean,
+                prior_cov,
+                0.001,
+                1e-6,
+                3000.0,
+                200,
+                20,
+                cache=cache,
+            )
+            self.assertEqual(cache.misses > 0, cached)
+            if cached:
+                self.assertEqual(cache.hits + cache.misses, result["num_evals"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,263 @@
+# src/tests/test_posterior.py
+
+import unittest
+
+import numpy as np
+import scipy.linalg as linalg
+
+from src.algorithm.posterior import block_posterior, PolicySnapshot, PosteriorState
+
+
+def make_problem(nusers, size=24, seed=0):
+    """Random sufficient statistics and hyperparameters for a small cohort"""
+    rng = np.random.default_rng(seed)
+
+    prior_mean = rng.normal(size=size)
+    prior_cov = np.diag(rng.uniform(0.01, 1.0, size=size))
+    L = np.tril(rng.normal(scale=0.02, size=(size, size)), -1) + np.diag(
+        rng.uniform(0.05, 0.3, size=size)
+    )
+    sigma_u = L @ L.T
+    noise_var = 0.85
+
+    A_hat = []
+    B_hat = []
+    for _ in range(nusers):
+        X = rng.binomial(1, 0.5, size=(rng.integers(2, 40), size)).astype(float)
+        y = rng.integers(0, 4, size=X.shape[0]).astype(float)
+        A_hat.append(X.T @ X)
+        B_hat.append(X.T @ y)
+
+    return prior_mean, prior_cov, sigma_u, noise_var, A_hat, np.array(B_hat)
+
+
+def dense_posterior(prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat):
+    """Reference posterior computed with the dense (24N x 24N) matrices"""
+    nusers = len(A_hat)
+
+    A = linalg.block_diag(*A_hat)
+    B = B_hat.flatten()
+    mu_0 = np.kron(np.ones(nusers), prior_mean)
+
+    Sigma_theta_t = np.kron(np.ones((nusers, nusers)), prior_cov) + np.kron(
+        np.identity(nusers), sigma_u
+    )
+    sigma_theta_t_inverse = np.linalg.inv(Sigma_theta_t)
+
+    posterior_cov = np.linalg.inv(sigma_theta_t_inverse + (1.0 / noise_var) * A)
+    posterior_mean = posterior_cov @ (
+        sigma_theta_t_inverse @ mu_0.reshape(-1, 1)
+        + (1.0 / noise_var * B).reshape(-1, 1)
+    )
+
+    zeta1 = zeta2 = zeta3 = zeta4 = None
+    m_inv = 1.0 / nusers
+    for i in range(nusers):
+        psi = noise_var * np.linalg.inv(sigma_u) + A_hat[i]
+        psi_inv = np.linalg.inv(psi)
+        z1 = B_hat[i]
+        z2 = A_hat[i] @ psi_inv @ B_hat[i]
+        z3 = A_hat[i]
+        z4 = A_hat[i] @ psi_inv @ A_hat[i]
+        zeta1 = z1 if zeta1 is None else zeta1 + z1
+        zeta2 = z2 if zeta2 is None else zeta2 + z2
+        zeta3 = z3 if zeta3 is None else zeta3 + z3
+        zeta4 = z4 if zeta4 is None else zeta4 + z4
+
+    E = (
+        m_inv * np.linalg.inv(prior_cov)
+        + (1.0 / noise_var) * m_inv * zeta3
+        - (1.0 / noise_var) * m_inv * zeta4
+    )
+    E_inv = np.linalg.inv(E)
+    theta_pop_mean = E_inv @ (
+        m_inv * np.linalg.inv(prior_cov) @ prior_mean.reshape(-1, 1)
+        + (1.0 / noise_var) * m_inv * zeta1.reshape(-1, 1)
+        - (1.0 / noise_var) * m_inv * zeta2.reshape(-1, 1)
+    )
+    theta_pop_cov = m_inv * E_inv
+
+    return posterior_mean, posterior_cov, theta_pop_mean, theta_pop_cov
+
+
+class TestBlockPosterior(unittest.TestCase):
+    """Tests for the block structured posterior engine"""
+
+    def test_matches_dense_posterior(self):
+        """Block posterior matches the dense computation"""
+        for nusers in [1, 2, 7]:
+            problem = make_problem(nusers, seed=nusers)
+            (
+                dense_mean,
+                dense_cov,
+                dense_pop_mean,
+                dense_pop_cov,
+            ) = dense_posterior(*problem)
+            state = block_posterior(*problem)
+
+            np.testing.assert_allclose(
+                state.mean.reshape(-1, 1), dense_mean, rtol=1e-6, atol=1e-8
+            )
+            np.testing.assert_allclose(
+                state.theta_pop_mean, dense_pop_mean, rtol=1e-6, atol=1e-8
+            )
+            np.testing.assert_allclose(
+                state.theta_pop_cov, dense_pop_cov, rtol=1e-6, atol=1e-8
+            )
+
+            size = state.cov_blocks.shape[1]
+            for i in range(nusers):
+                for j in range(nusers):
+                    np.testing.assert_allclose(
+                        state.cov_block(i, j),
+                        dense_cov[i * size : (i + 1) * size, j * size : (j + 1) * size],
+                        rtol=1e-6,
+                        atol=1e-8,
+                    )
+
+            np.testing.assert_allclose(
+                state.dense_cov(), dense_cov, rtol=1e-6, atol=1e-8
+            )
+
+    def test_params_round_trip(self):
+        """Posterior state survives serialization, including the dense format"""
+        problem = make_problem(3)
+        state = block_posterior(*problem)
+        params = state.to_params()
+
+        restored = PosteriorState.from_params(
+            np.array(params["posterior_mean_array"]),
+            np.array(params["posterior_var_array"]),
+            params["posterior_gain_array"],
+            state.theta_pop_mean,
+            state.theta_pop_cov,
+        )
+        np.testing.assert_array_equal(restored.mean, state.mean)
+        np.testing.assert_array_equal(restored.cov_block(0, 2), state.cov_block(0, 2))
+
+        legacy = PosteriorState.from_params(
+            np.array(params["posterior_mean_array"]),
+            state.dense_cov(),
+            None,
+            state.theta_pop_mean,
+            state.theta_pop_cov,
+        )
+        np.testing.assert_allclose(legacy.cov_blocks, state.cov_blocks)
+        with self.assertRaises(ValueError):
+            legacy.cov_block(0, 1)
+
+    def test_rank_one_update_matches_batch(self):
+        """Rank-one refresh of a user matches a batch update with the new row"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(4)
+        state = block_posterior(prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat)
+
+        x = np.random.default_rng(1).binomial(1, 0.5, size=B_hat.shape[1]).astype(float)
+        y = 2.0
+        refreshed = state.rank_one_update(2, x, y, noise_var)
+
+        A_hat[2] = A_hat[2] + np.outer(x, x)
+        B_hat[2] = B_hat[2] + y * x
+        batch = block_posterior(prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat)
+
+        np.testing.assert_allclose(refreshed.mean_block(2), batch.mean_block(2), rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(refreshed.cov_block(2), batch.cov_block(2), rtol=1e-6, atol=1e-8)
+
+        # The original state is left untouched
+        self.assertFalse(np.allclose(state.cov_block(2), refreshed.cov_block(2)))
+        np.testing.assert_array_equal(state.mean_block(1), refreshed.mean_block(1))
+
+
+class TestPolicySnapshot(unittest.TestCase):
+    """Tests for the per-user blocks precomputed by the policy snapshot"""
+
+    def test_advantage_blocks(self):
+        """Advantage blocks match the posterior state, including refreshed users"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(3)
+        state = block_posterior(prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat)
+        snapshot = PolicySnapshot(
+            policyid=1,
+            user_list=["a", "b", "c"],
+            posterior_state=state,
+            theta_pop_mean=state.theta_pop_mean,
+            theta_pop_cov=state.theta_pop_cov,
+            sigma_u=sigma_u,
+            noise_var=noise_var,
+        )
+
+        x = np.ones(B_hat.shape[1])
+        refreshed = snapshot.replace(
+            posterior_state=state.rank_one_update(1, x, 2.0, noise_var)
+        )
+
+        for snap in [snapshot, refreshed]:
+            for user_id, i in snap.user_index.items():
+                self.assertEqual(snap.user_list[i], user_id)
+                np.testing.assert_array_equal(
+                    snap.beta_mean[i], snap.posterior_state.mean_block(i)[-8:]
+                )
+                np.testing.assert_array_equal(
+                    snap.beta_cov[i], snap.posterior_state.cov_block(i)[-8:, -8:]
+                )
+
+        self.assertFalse(np.allclose(snapshot.beta_cov[1], refreshed.beta_cov[1]))
+        np.testing.assert_array_equal(
+            snapshot.new_user_mean, state.theta_pop_mean.flatten()[-8:]
+        )
+        np.testing.assert_allclose(
+            snapshot.new_user_cov, (state.theta_pop_cov + sigma_u)[-8:, -8:]
+        )
+        with self.assertRaises(AttributeError):
+            snapshot.beta_mean = None
+
+    def test_refresh_user_is_copy_on_write(self):
+        """A refreshed user only overrides its own rows, the arrays are shared"""
+        prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat = make_problem(3)
+        state = block_posterior(prior_mean, prior_cov, sigma_u, noise_var, A_hat, B_hat)
+        snapshot = PolicySnapshot(
+            policyid=1,
+            user_list=["a", "b", "c"],
+            posterior_state=state,
+            theta_pop_mean=state.theta_pop_mean,
+            theta_pop_cov=state.theta_pop_cov,
+            sigma_u=sigma_u,
+            noise_var=noise_var,
+            prob_table=np.full((4, 8), 0.5),
+        )
+
+        x = np.ones(B_hat.shape[1])
+        refreshed = snapshot.refresh_user(
+            1, state.rank_one_update(1, x, 2.0, noise_var), np.full(8, 0.7)
+        )
+        refreshed = refreshed.refresh_user(
+            2,
+            refreshed.posterior_state.rank_one_update(2, x, 1.0, noise_var),
+            np.full(8, 0.3),
+        )
+
+        for name in ["user_index", "beta_mean", "beta_cov", "prob_table"]:
+            self.assertIs(getattr(refreshed, name), getattr(snapshot, name))
+        self.assertEqual(refreshed.policyid, snapshot.policyid)
+
+        for i in range(3):
+            mean, cov = refreshed.advantage_block(i)
+            np.testing.assert_array_equal(
+                mean, refreshed.posterior_state.mean_block(i)[-8:]
+            )
+            np.testing.assert_array_equal(
+                cov, refreshed.posterior_state.cov_block(i)[-8:, -8:]
+            )
+        np.testing.assert_array_equal(refreshed.prob_row(0), np.full(8, 0.5))
+        np.testing.assert_array_equal(refreshed.prob_row(1), np.full(8, 0.7))
+        np.testing.assert_array_equal(refreshed.prob_row(2), np.full(8, 0.3))
+        np.testing.assert_array_equal(refreshed.prob_row(3), np.full(8, 0.5))
+
+        # The published snapshot is left untouched
+        self.assertEqual(snapshot.overrides, {})
+        np.testing.assert_array_equal(snapshot.prob_row(1), np.full(8, 0.5))
+        np.testing.assert_array_equal(
+            snapshot.advantage_block(1)[1], state.cov_block(1)[-8:, -8:]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()